@@ -5,7 +5,7 @@ Write results to stdout.
 """
 
 ## file version
-__version__ = "1.2.0"
+__version__ = "1.13.0"
 
 import sys
 import os
@@ -16,7 +16,23 @@ import locale
 import signal
 import operator
 import string
+import math
+import heapq
+import tempfile
+import shutil
+import hashlib
+import zlib
+import json
+import mmap
+import struct
+import time
+import cPickle
+import cStringIO
+from array import array
 from collections import defaultdict
+from itertools import chain, imap, izip, groupby
+from bisect import bisect_left, bisect_right
+from multiprocessing import Pool
 
 
 def signal_handler(signal, frame):
@@ -31,6 +47,44 @@ signal.signal(signal.SIGPIPE, signal_handler)
 # setup locale to allow comma separated value printing
 locale.setlocale(locale.LC_ALL, 'en_US')
 
+## approximate ratio of uncompressed to compressed input file size
+COMPRESSION_RATIO = 4
+
+## approximate ratio of lookup dictionary memory use to input file size
+MEMORY_RATIO = 5
+
+## minimum number of records sharing a key for the multi-match selectors to
+## use a ConstraintIndex rather than scanning them
+INDEX_MIN_ITEMS = 16
+
+## magic number identifying a saved lookup index (see write_index)
+INDEX_MAGIC = "KJI1"
+
+## suffix of saved lookup index files
+INDEX_SUFFIX = ".kji"
+
+## files and settings inherited by load_lookup_job workers
+_shared = dict()
+
+## default number of bytes of merged records collected before writing them
+## out in a single call (see probe_lines)
+OUTPUT_BUFFER = 1 << 20
+
+## minimum number of seconds between progress updates of the probe loop
+PROGRESS_INTERVAL = 1.0
+
+## number of records of the first file between checks of the clock, for
+## progress updates
+PROGRESS_CHECK = 4096
+
+## number of keys of a lookup dictionary whose contents are measured when
+## estimating its size (see lookup_size)
+SIZE_SAMPLE = 10000
+
+## maximum number of times a partition is split to fit the memory budget.
+## Partitions dominated by a single key cannot shrink by further splitting
+MAX_PARTITION_DEPTH = 3
+
 
 class EmptyStdinError(Exception):
     """
@@ -44,6 +98,17 @@ class EmptyStdinError(Exception):
         return(repr(self.value))
 
 
+class InputOrderError(Exception):
+    """
+    Raised when a file expected to be sorted by its join key values is not.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return(repr(self.value))
+
+
 def prep_arg_parser():
     """
     Define any command line arguments passed to the script.
@@ -71,6 +136,10 @@ def prep_arg_parser():
                    help="Remove field named F1 from merged output.")
     p.add_argument("-k", "--key", action='append', metavar="F1",
                    help="add a new join field named F1.")
+    p.add_argument("-K", "--keep", action='append', metavar="F1",
+                   help="%s %s" % (
+                   "Keep field named F1 of the files after the first.  If",
+                   "given, their other non-key fields are not loaded."))
     p.add_argument("-c", "--closest", action='append', metavar="F1",
                    help="%s %s %s" % (
                    "Constrain multiple key matches by selecting the record",
@@ -96,6 +165,49 @@ def prep_arg_parser():
                    "Constrain multiple key matches by selecting the record",
                    "with the smallest value for field F1 that is > to the F1",
                    "value being joined"))
+    p.add_argument("-C", "--cores", type=int, default=1,
+                   help="%s %s" % (
+                   "hash partition the files by join key and join the",
+                   "partitions in parallel on this many cores"))
+    p.add_argument("-o", "--ordered", action='store_true',
+                   help="%s %s" % (
+                   "with --cores, write merged records in the order of the",
+                   "first file (otherwise they are grouped by partition)"))
+    p.add_argument("-j", "--loaders", type=int, default=1,
+                   help="%s %s" % (
+                   "load the files after the first concurrently in up to",
+                   "this many processes"))
+    p.add_argument("-B", "--budget", type=int, default=0, metavar="MB",
+                   help="%s %s %s" % (
+                   "if the lookup dictionaries would need more than MB",
+                   "megabytes of memory, hash partition the files to disk",
+                   "and join them one partition at a time"))
+    p.add_argument("-I", "--index", metavar="DIR",
+                   help="%s %s %s" % (
+                   "save the lookup dictionary of each file (other than the",
+                   "first) as an index in DIR, and memory map saved indices",
+                   "of unchanged files instead of reading them again"))
+    p.add_argument("-z", "--compact", action='count', default=0,
+                   help="%s %s %s" % (
+                   "use less memory for lookup dictionaries by interning",
+                   "strings and not listing single records.  Repeat to also",
+                   "pack all record values into a single buffer"))
+    p.add_argument("-b", "--buffer", type=int, default=OUTPUT_BUFFER,
+                   metavar="BYTES",
+                   help="%s %s %s" % (
+                   "collect up to this many bytes of merged records before",
+                   "writing them to stdout at once.  Use 0 to write each",
+                   "record as soon as it is merged"))
+    p.add_argument("-P", "--prescreen", action='store_true',
+                   help="%s %s %s" % (
+                   "for inner joins, only keep keys common to every file",
+                   "other than the first, and cheaply reject records of the",
+                   "first file whose key isn't one of them"))
+    p.add_argument("--sorted", action='store_true',
+                   help="%s %s %s" % (
+                   "all files are sorted by their join key values (as by",
+                   "LC_ALL=C sort): merge join them in a single streaming",
+                   "pass instead of loading lookup dictionaries"))
     p.add_argument("file", metavar="FILE", nargs='*', default="-",
                    help="read input from FILE.  You can use '-' to " +
                    "specify stdin explicitly but it will also be checked")
@@ -143,7 +255,246 @@ def extract_named_vals(values, names, keep_names=None, rm_names=None):
     return tuple(res)
 
 
-def create_join_dict(f, headers, keys, rm_vals=None, delim='\t'):
+class ConstraintIndex(list):
+    """
+    The value tuples sharing a join key in a lookup dictionary, along with
+    their multi-match field values sorted (and numericized) once up front, so
+    the select_* functions can bisect them instead of scanning every item.
+    Ties are resolved in favour of the item appearing first in the file, just
+    as when scanning.
+    """
+    def __init__(self, items, field_idcs):
+        """
+        Create a new instance.
+        @param items list of value tuples, in file order
+        @param field_idcs 0-based offsets of the multi-match fields in each
+               value tuple
+        """
+        list.__init__(self, items)
+        vals = [[item[x] for x in field_idcs] for item in items]
+        # a stable sort keeps tied items in file order
+        self.order = sorted(xrange(len(vals)), key=vals.__getitem__)
+        self.vals = [vals[x] for x in self.order]
+        self.numerics = [numericize(x) for x in vals]
+        self.nums = None
+        if len(field_idcs) == 1 and not any(math.isnan(x[0]) for x in
+                                            self.numerics):
+            nums = [x[0] for x in self.numerics]
+            self.num_order = sorted(xrange(len(nums)), key=nums.__getitem__)
+            self.nums = [nums[x] for x in self.num_order]
+
+    def select_op(self, cmp_vals, this_cmp_op):
+        """
+        Select the item select_next_op would, by bisection.
+        @param cmp_vals list of the multi-match field values being joined
+        @param this_cmp_op one of operator.le, lt, ge or gt
+        @return the selected value tuple, or None if no item is valid
+        """
+        vals = self.vals
+        if this_cmp_op is operator.le:
+            idx = bisect_right(vals, cmp_vals) - 1
+        elif this_cmp_op is operator.lt:
+            idx = bisect_left(vals, cmp_vals) - 1
+        elif this_cmp_op is operator.ge:
+            idx = bisect_left(vals, cmp_vals)
+        else:
+            idx = bisect_right(vals, cmp_vals)
+        if idx < 0 or idx >= len(vals):
+            return None
+        # the first item (in file order) of any run of tied values
+        return self[self.order[bisect_left(vals, vals[idx])]]
+
+    def select_closest(self, cmp_vals):
+        """
+        Select the item select_closest would, by bisection.  This is only
+        possible for a single multi-match field whose values are all numeric.
+        @param cmp_vals list of the multi-match field values being joined
+        @return the selected value tuple, or None if bisection isn't possible
+        """
+        if self.nums is None or len(cmp_vals) != 1:
+            return None
+        val = numericize(cmp_vals[0])
+        if math.isnan(val) or math.isinf(val):
+            return None
+        nums = self.nums
+        idx = bisect_left(nums, val)
+        best = None
+        # the closest value either directly precedes or follows val
+        for pos in (idx - 1, idx):
+            if 0 <= pos < len(nums):
+                cand = (abs(val - nums[pos]),
+                        self.num_order[bisect_left(nums, nums[pos])])
+                if best is None or cand < best:
+                    best = cand
+        return self[best[1]]
+
+
+class CompactLookup(dict):
+    """
+    Lookup dictionary using less memory than the default defaultdict(list):
+    the value tuple of a key with a single record is stored directly rather
+    than in a list of its own.  Lookups still return lists of value tuples.
+    """
+    def add(self, key, vals):
+        """
+        Store the values of a record.
+        @param key tuple of join key values
+        @param vals the record's values
+        """
+        items = self.get(key)
+        if items is None:
+            dict.__setitem__(self, key, vals)
+        elif isinstance(items, list):
+            items.append(vals)
+        else:
+            dict.__setitem__(self, key, [items, vals])
+
+    def unpack(self, vals):
+        """
+        Convert stored values back to a value tuple.
+        @param vals the values as stored
+        @return value tuple
+        """
+        return vals
+
+    def __getitem__(self, key):
+        """
+        Return the value tuples of the given key.
+        @param key tuple of join key values
+        @return list of value tuples, in file order
+        @throws KeyError if the key isn't present
+        """
+        items = dict.__getitem__(self, key)
+        if isinstance(items, ConstraintIndex):
+            return items
+        elif isinstance(items, list):
+            return [self.unpack(x) for x in items]
+        return [self.unpack(items)]
+
+    def iteritems(self):
+        """
+        Iterate over keys and their lists of value tuples.
+        @return generator of (key, list of value tuples) pairs
+        """
+        for key in self:
+            yield (key, self[key])
+
+    def __reduce__(self):
+        """
+        Pickle the values as stored, rather than as returned by lookups.
+        """
+        return (self.__class__, (), self.__dict__, None,
+                dict.iteritems(self))
+
+
+class PackedLookup(CompactLookup):
+    """
+    CompactLookup that packs the values of every record into a single byte
+    buffer, as delimiter joined, newline terminated strings, and stores only
+    their offsets in the dictionary.  Value tuples are rebuilt on lookup.
+    """
+    def __init__(self, delim="\t", num_fields=0):
+        """
+        Create a new, empty instance.
+        @param delim the field separator
+        @param num_fields number of values in each value tuple
+        """
+        dict.__init__(self)
+        self.buf = bytearray()
+        self.delim = delim
+        self.num_fields = num_fields
+
+    def add(self, key, vals):
+        """
+        Store the values of a record.
+        @param key tuple of join key values
+        @param vals sequence of the record's values
+        """
+        offset = len(self.buf)
+        self.buf.extend(self.delim.join(vals))
+        self.buf.append("\n")
+        CompactLookup.add(self, key, offset)
+
+    def unpack(self, offset):
+        """
+        Rebuild a value tuple from the buffer.
+        @param offset position of the values in the buffer
+        @return value tuple
+        """
+        if self.num_fields == 0:
+            return ()
+        return tuple(str(self.buf[offset:self.buf.find("\n", offset)]).split(
+            self.delim))
+
+
+def object_size(obj, seen):
+    """
+    Add up the memory taken by an object and those it refers to, as
+    reported by sys.getsizeof.  Objects already counted are skipped.
+    @param obj a string, number, tuple, list, dictionary or instance of a
+           class built from them
+    @param seen set of the ids of the objects already counted.  Updated
+    @return size in bytes
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(object_size(x, seen) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(object_size(x, seen) + object_size(y, seen) for x, y in
+                    obj.iteritems())
+    if hasattr(obj, "__dict__"):
+        size += object_size(obj.__dict__, seen)
+    return size
+
+
+def lookup_size(d):
+    """
+    Estimate the memory taken by a lookup dictionary: its hash table (and
+    buffer, for a PackedLookup) plus the keys and values stored, measured
+    exactly for up to SIZE_SAMPLE keys and scaled up for the rest.
+    @param d lookup dictionary built by create_join_dict
+    @return 2-tuple containing the number of value tuples held and the
+            estimated size in bytes
+    """
+    size = sys.getsizeof(d)
+    if isinstance(d, PackedLookup):
+        size += sys.getsizeof(d.buf)
+    num_recs = 0
+    sampled = 0
+    sample_size = 0
+    seen = set()
+    # the values as stored, rather than as returned by lookups
+    for key, items in dict.iteritems(d):
+        num_recs += len(items) if isinstance(items, list) else 1
+        if sampled < SIZE_SAMPLE:
+            sampled += 1
+            sample_size += object_size(key, seen) + object_size(items, seen)
+    if sampled > 0:
+        size += sample_size * len(d) // sampled
+    return (num_recs, size)
+
+
+def report_lookup(name, d):
+    """
+    Write the record and key count of a lookup dictionary, and its
+    estimated memory use per record, to stderr.
+    @param name name of the file the dictionary was loaded from
+    @param d lookup dictionary built by create_join_dict
+    """
+    num_recs, size = lookup_size(d)
+    sys.stderr.write("%s: %s records, %s keys, ~%s bytes/record\n" %
+                     (name, locale.format("%d", num_recs, grouping=True),
+                      locale.format("%d", len(d), grouping=True),
+                      locale.format("%d", size // max(num_recs, 1),
+                                    grouping=True)))
+
+
+def create_join_dict(f, headers, keys, rm_vals=None, delim='\t',
+                     print_every=1000, mm_idcs=None, key_filter=None,
+                     compact=0):
     """
     Construct and return a dictionary from the contents of file f.
     keys should be a tuple based on keys (a subset of headers).  Remaining
@@ -155,22 +506,56 @@ def create_join_dict(f, headers, keys, rm_vals=None, delim='\t'):
     @param rm_vals list of strings containing field header names to
            drop from list of fields
     @param delim field delimiter to split f by
+    @param print_every write the line count to stderr every this many lines.
+           Set to 0 to write no progress at all
+    @param mm_idcs if given, 0-based offsets of the multi-match fields in
+           the value tuples.  Keys with many value tuples then get a
+           ConstraintIndex over these fields instead of a plain list
+    @param key_filter if given, only records whose key values are in this
+           container are stored
+    @param compact if 1, repeated strings are interned and a CompactLookup
+           is built.  If 2 or more, a PackedLookup is built.  Defaults to 0
+           for a defaultdict(list)
     @return new dictionary contructed from the contents of f.
     """
-    print_every = 1000
-    d = defaultdict(list)
-    sys.stderr.write("building lookup dictionary from: %s\n" % f.filename())
+    if print_every > 0:
+        sys.stderr.write("building lookup dictionary from: %s\n" %
+                         f.filename())
     rm = keys + rm_vals if rm_vals is not None else keys
     k_idcs = extract_named_vals(range(len(headers)), headers, keys)
     v_idcs = extract_named_vals(range(len(headers)), headers, None, rm)
+    if compact >= 2:
+        d = PackedLookup(delim, len(v_idcs))
+    elif compact == 1:
+        d = CompactLookup()
+    else:
+        d = defaultdict(list)
+    num_recs = 0
+    # no need to split beyond the last field used
+    max_split = max(k_idcs + v_idcs) + 1 if len(k_idcs + v_idcs) > 0 else 0
     for ln in f:
-        if f.filelineno() % print_every == 0:
+        if print_every > 0 and f.filelineno() % print_every == 0:
             sys.stderr.write(locale.format("%d", f.filelineno(), grouping=True)
                              + "\r")
-        rec = ln.rstrip('\n').split(delim)
-        d[tuple([rec[x] for x in k_idcs])].append(tuple(
-                [rec[x] for x in v_idcs]))
-    sys.stderr.write("\n")
+        rec = ln.rstrip('\n').split(delim, max_split)
+        key = tuple([rec[x] for x in k_idcs])
+        if key_filter is not None and key not in key_filter:
+            continue
+        num_recs += 1
+        if compact == 0:
+            d[key].append(tuple([rec[x] for x in v_idcs]))
+        elif compact == 1:
+            d.add(tuple([intern(x) for x in key]),
+                  tuple([intern(rec[x]) for x in v_idcs]))
+        else:
+            d.add(tuple([intern(x) for x in key]), [rec[x] for x in v_idcs])
+    if mm_idcs:
+        for key, items in d.iteritems():
+            if len(items) >= INDEX_MIN_ITEMS:
+                d[key] = ConstraintIndex(items, mm_idcs)
+    if print_every > 0:
+        sys.stderr.write("\n")
+        report_lookup(f.filename(), d)
     return d
 
 
@@ -217,6 +602,11 @@ def select_next_op(items, field_idcs, cmp_vals, this_cmp_op, replace_op):
     the length of the first item.
     Typically this_cmp_op and replace_op are given operator.le, lt, ge, or gt
     """
+    if isinstance(items, ConstraintIndex):
+        res = items.select_op(cmp_vals, this_cmp_op)
+        if res is None:
+            return (tuple([''] * len(items[0])), False)
+        return (res, True)
     res = None
     res_vals = None
     valid = False
@@ -240,12 +630,19 @@ def select_closest(items, field_idcs, cmp_vals):
     """
     Attempt to convert the values to numerics and find the single closest match
     """
+    if isinstance(items, ConstraintIndex):
+        res = items.select_closest(cmp_vals)
+        if res is not None:
+            return (res, True)
+        numerics = items.numerics
+    else:
+        numerics = (numericize([item[x] for x in field_idcs])
+                    for item in items)
     res = None
     res_diffs = None
     valid = False
     ncmp_vals = numericize(cmp_vals)
-    for item in items:
-        this_vals = numericize([item[x] for x in field_idcs])
+    for item, this_vals in izip(items, numerics):
         diffs = [abs(x[0] - x[1]) for x in zip(ncmp_vals, this_vals)]
         if res_diffs is None or diffs < res_diffs:
             valid = True
@@ -293,9 +690,876 @@ def numericize(x, defval=float("nan")):
     return res
 
 
+class SortedRunLookup(object):
+    """
+    Stand-in for the dictionary built by create_join_dict, for a file sorted
+    by its join key values.  Lookups must be made in ascending key order: the
+    file is read forward as needed, and only the run of records sharing the
+    most recently read key is held in memory.  Keys are compared as tuples of
+    strings (i.e. as sorted by `LC_ALL=C sort`).
+    """
+    def __init__(self, f, headers, keys, rm_vals=None, delim='\t',
+                 mm_idcs=None):
+        """
+        Create a new instance.
+        @param f an open fileinput object ready for reading
+        @param headers list of strings containing field header names
+        @param keys list of strings containing the join key field names
+        @param rm_vals list of strings containing field header names to
+               drop from list of fields
+        @param delim field delimiter to split f by
+        @param mm_idcs if given, 0-based offsets of the multi-match fields in
+               the value tuples, used to index long runs (see
+               create_join_dict)
+        """
+        rm = keys + rm_vals if rm_vals is not None else keys
+        self.k_idcs = extract_named_vals(range(len(headers)), headers, keys)
+        self.v_idcs = extract_named_vals(range(len(headers)), headers, None,
+                                         rm)
+        self.f = f
+        self.delim = delim
+        self.mm_idcs = mm_idcs
+        self.runs = self.read_runs()
+        self.key = None
+        self.vals = None
+        self.probe = None
+        self.advance()
+
+    def read_runs(self):
+        """
+        Group the records of the file into runs sharing the same key values.
+        @return generator of (key values tuple, list of value tuples) pairs
+        @throws InputOrderError if the file is not sorted by key
+        """
+        prev = None
+        max_split = max(self.k_idcs + self.v_idcs) + 1
+        recs = (ln.rstrip('\n').split(self.delim, max_split) for ln in self.f)
+        for key, run in groupby(recs, lambda rec: tuple([rec[x] for x in
+                                                         self.k_idcs])):
+            if prev is not None and key < prev:
+                raise InputOrderError("%s line %d: %s follows %s" %
+                                      (self.f.filename(), self.f.filelineno(),
+                                       key, prev))
+            prev = key
+            items = [tuple([rec[x] for x in self.v_idcs]) for rec in run]
+            if self.mm_idcs and len(items) >= INDEX_MIN_ITEMS:
+                items = ConstraintIndex(items, self.mm_idcs)
+            yield (key, items)
+
+    def advance(self):
+        """
+        Move to the next run of records, if any remain.
+        """
+        try:
+            self.key, self.vals = next(self.runs)
+        except StopIteration:
+            self.key, self.vals = None, None
+
+    def __contains__(self, key):
+        """
+        Read forward to the run of records having the given key values.
+        @param key tuple of join key values
+        @return True if such a run exists
+        @throws InputOrderError if keys are looked up out of order
+        """
+        if self.probe is not None and key < self.probe:
+            raise InputOrderError("first file: %s follows %s" %
+                                  (key, self.probe))
+        self.probe = key
+        while self.key is not None and self.key < key:
+            self.advance()
+        return self.key == key
+
+    def __getitem__(self, key):
+        """
+        Return the run of records having the given key values.
+        @param key tuple of join key values, as last passed to __contains__
+        @return list of value tuples
+        @throws KeyError if no such run exists
+        """
+        if key not in self:
+            raise KeyError(key)
+        return self.vals
+
+
+def pad8(size):
+    """
+    Round a size up to a multiple of 8 bytes.
+    @param size number of bytes
+    @return padded number of bytes
+    """
+    return (size + 7) & ~7
+
+
+def index_path(index_dir, fname, keys, fields, delim):
+    """
+    Determine where the saved index of a file belongs.
+    @param index_dir directory holding saved indices
+    @param fname name of the indexed file
+    @param keys list of the join key field names
+    @param fields list of the stored (non-key, non-removed) field names
+    @param delim the field separator
+    @return index file name.  The same file is reused (overwritten) when the
+            indexed file changes
+    """
+    ident = hashlib.md5("\0".join([os.path.abspath(fname), delim] + keys +
+                                  fields)).hexdigest()[:16]
+    return os.path.join(index_dir, "%s.%s%s" % (os.path.basename(fname),
+                                                ident, INDEX_SUFFIX))
+
+
+def index_signature(fname, keys, fields, delim):
+    """
+    Identify the exact contents a saved index was built from.
+    @param fname name of the indexed file
+    @param keys list of the join key field names
+    @param fields list of the stored (non-key, non-removed) field names
+    @param delim the field separator
+    @return hex digest string covering the file's path, size and modification
+            time, and the fields indexed
+    """
+    st = os.stat(fname)
+    return hashlib.md5("\0".join([os.path.abspath(fname), repr(st.st_mtime),
+                                  str(st.st_size), delim] + keys +
+                                 fields)).hexdigest()
+
+
+def write_index(fname, d, signature, delim="\t", num_fields=0):
+    """
+    Save a lookup dictionary to an index file, which MappedLookup can later
+    memory map.  The file is the magic number INDEX_MAGIC, a little-endian
+    uint32 header length and a JSON header, padded to 8 bytes.  An open
+    addressing hash table of uint64 entry offsets (+ 1, 0 marking an empty
+    slot), indexed by the crc32 of the delimiter joined key values, follows.
+    Last come the entries: uint32 key and value lengths, the joined key values
+    and the value tuples, each joined and newline terminated.
+    @param fname name of the index file to write.  It is replaced atomically
+    @param d lookup dictionary, as built by create_join_dict
+    @param signature index_signature of the indexed file
+    @param delim the field separator
+    @param num_fields number of values in each value tuple
+    """
+    nslots = 1
+    while nslots < 2 * len(d):
+        nslots *= 2
+    mask = nslots - 1
+    slots = array('L', [0]) * nslots
+    entries = tempfile.TemporaryFile()
+    offset = 0
+    for key, items in d.iteritems():
+        keystr = delim.join(key)
+        vals = "".join([delim.join(x) + "\n" for x in items])
+        slot = zlib.crc32(keystr) & mask
+        while slots[slot] != 0:
+            slot = (slot + 1) & mask
+        slots[slot] = offset + 1
+        entries.write(struct.pack('<2I', len(keystr), len(vals)))
+        entries.write(keystr)
+        entries.write(vals)
+        offset += 8 + len(keystr) + len(vals)
+    hdr = json.dumps(dict(signature=signature, delim=delim,
+                          num_fields=num_fields, keys=len(d), slots=nslots))
+    fd, tmpname = tempfile.mkstemp(prefix="keyed_join_",
+                                   dir=os.path.dirname(fname) or ".")
+    renamed = False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<I', len(hdr)))
+            f.write(hdr)
+            f.write("\0" * (pad8(8 + len(hdr)) - 8 - len(hdr)))
+            for idx in xrange(0, nslots, 65536):
+                chunk = slots[idx:idx + 65536]
+                f.write(struct.pack('<%dQ' % len(chunk), *chunk))
+            entries.seek(0)
+            shutil.copyfileobj(entries, f)
+        os.rename(tmpname, fname)
+        renamed = True
+    finally:
+        # don't leave a partial index behind, even if interrupted
+        if not renamed:
+            os.remove(tmpname)
+        entries.close()
+
+
+class MappedLookup(object):
+    """
+    Read-only stand-in for the dictionary built by create_join_dict, backed by
+    a memory mapped index file (see write_index).  Nothing is parsed up front:
+    each lookup hashes the key values to find its entry, and the value tuples
+    of an entry are only split when requested.  Keys with many value tuples
+    get the same ConstraintIndex as in the dictionary, built on first lookup.
+    """
+    def __init__(self, fname, mm_idcs=None):
+        """
+        Memory map an index file.
+        @param fname name of the index file
+        @param mm_idcs see create_join_dict
+        """
+        self.f = open(fname, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        hdr_len = struct.unpack_from('<I', self.mm, len(INDEX_MAGIC))[0]
+        start = len(INDEX_MAGIC) + 4
+        self.meta = json.loads(self.mm[start:start + hdr_len])
+        self.delim = str(self.meta['delim'])
+        self.num_fields = self.meta['num_fields']
+        self.mask = self.meta['slots'] - 1
+        self.slots_at = pad8(start + hdr_len)
+        self.entries_at = self.slots_at + 8 * self.meta['slots']
+        self.last_key = None
+        self.last_entry = None
+        self.mm_idcs = mm_idcs
+        self.indexed = dict()
+
+    def find(self, key):
+        """
+        Locate the values of the given key in the index.
+        @param key tuple of join key values
+        @return (offset, length) tuple of the key's value bytes, or None if
+                the key isn't present
+        """
+        if key == self.last_key:
+            return self.last_entry
+        keystr = self.delim.join(key)
+        slot = zlib.crc32(keystr) & self.mask
+        entry = None
+        while True:
+            offset = struct.unpack_from('<Q', self.mm,
+                                        self.slots_at + 8 * slot)[0]
+            if offset == 0:
+                break
+            pos = self.entries_at + offset - 1
+            klen, vlen = struct.unpack_from('<2I', self.mm, pos)
+            if self.mm[pos + 8:pos + 8 + klen] == keystr:
+                entry = (pos + 8 + klen, vlen)
+                break
+            slot = (slot + 1) & self.mask
+        self.last_key = key
+        self.last_entry = entry
+        return entry
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __getitem__(self, key):
+        """
+        Return the value tuples of the given key.
+        @param key tuple of join key values
+        @return list of value tuples, in file order
+        @throws KeyError if the key isn't present
+        """
+        items = self.indexed.get(key)
+        if items is not None:
+            return items
+        entry = self.find(key)
+        if entry is None:
+            raise KeyError(key)
+        lines = self.mm[entry[0]:entry[0] + entry[1]].split("\n")[:-1]
+        if self.num_fields == 0:
+            items = [()] * len(lines)
+        else:
+            items = [tuple(x.split(self.delim)) for x in lines]
+        if self.mm_idcs and len(items) >= INDEX_MIN_ITEMS:
+            items = ConstraintIndex(items, self.mm_idcs)
+            self.indexed[key] = items
+        return items
+
+    def __len__(self):
+        return self.meta['keys']
+
+    def close(self):
+        """
+        Release the memory map.
+        """
+        self.mm.close()
+        self.f.close()
+
+
+def indexed_lookup(f, headers, keys, rm_vals, delim, index_dir,
+                   print_every=1000, mm_idcs=None, compact=0):
+    """
+    Obtain the lookup structure of a file from its saved index in index_dir,
+    first building the lookup dictionary and saving its index if the index is
+    missing or the file has changed since it was built.
+    @param f an open fileinput object positioned after its header line
+    @param headers list of strings containing field header names
+    @param keys list of strings containing the join key field names
+    @param rm_vals list of strings containing field header names to drop
+    @param delim the field separator
+    @param index_dir directory holding saved indices
+    @param print_every see create_join_dict
+    @param mm_idcs see create_join_dict
+    @param compact see create_join_dict
+    @return a MappedLookup, or the newly built dictionary
+    """
+    rm = keys + rm_vals if rm_vals is not None else keys
+    fields = list(extract_named_vals(headers, headers, None, rm))
+    fname = f.filename()
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    path = index_path(index_dir, fname, keys, fields, delim)
+    signature = index_signature(fname, keys, fields, delim)
+    if os.path.exists(path):
+        lookup = MappedLookup(path, mm_idcs)
+        if lookup.meta['signature'] == signature:
+            if print_every > 0:
+                sys.stderr.write("using lookup index: %s (%s keys, %s "
+                                 "bytes mapped)\n" %
+                                 (path, locale.format("%d", len(lookup),
+                                                      grouping=True),
+                                  locale.format("%d", len(lookup.mm),
+                                                grouping=True)))
+            return lookup
+        lookup.close()
+    d = create_join_dict(f, headers, keys, rm_vals, delim, print_every,
+                         mm_idcs, None, compact)
+    if print_every > 0:
+        sys.stderr.write("saving lookup index: %s\n" % path)
+    write_index(path, d, signature, delim, len(fields))
+    return d
+
+
+class JoinPlan(object):
+    """
+    The field layout of a join, worked out once from the (renamed) headers of
+    the files being merged, along with the options controlling how matches
+    are made.
+    """
+    def __init__(self, hmerge, merge_keys, rm_keys, delim="\t",
+                 outer_join=False, multi_match_fn=None,
+                 multi_match_fields=[], prescreen=False, keep_fields=None,
+                 compact=0):
+        """
+        Create a new instance.
+        @param hmerge list containing the list of field names of each file,
+               lowercased if case is being ignored
+        @param merge_keys list of the join key field names
+        @param rm_keys list of the field names to remove from the output
+        @param delim the field separator
+        @param outer_join perform a left outer join instead of an inner join?
+        @param multi_match_fn function selecting a single item where multiple
+               records exist for the same key, or None to take the first
+        @param multi_match_fields fields passed to multi_match_fn
+        @param prescreen for inner joins, only store records of each file
+               whose keys are also in the files loaded before it, and reject
+               records of the first file having keys missing from any of the
+               others before splitting them in full (see load_lookups)
+        """
+        self.hmerge = hmerge
+        self.merge_keys = merge_keys
+        self.rm_keys = rm_keys
+        self.delim = delim
+        self.outer_join = outer_join
+        self.multi_match_fn = multi_match_fn
+        self.prescreen = prescreen and not outer_join
+        self.compact = compact
+        # fields to drop from each file: those removed, and for the files
+        # other than the first any not being kept
+        self.rm_lists = [rm_keys]
+        for h in hmerge[1:]:
+            if keep_fields is None:
+                self.rm_lists.append(rm_keys)
+            else:
+                keep = keep_fields + merge_keys + list(multi_match_fields)
+                self.rm_lists.append(rm_keys + [x for x in h if x not in
+                                                keep])
+        # get multi-match field indices: within the records of the first
+        # file, and within the lookup dictionary value tuples of the others
+        self.mm_idcs = [tuple([hmerge[0].index(x) for x in multi_match_fields
+                               if x in hmerge[0]])]
+        self.oj_empties = list()
+        for h, rm in zip(hmerge[1:], self.rm_lists[1:]):
+            fields = [x for x in h if x not in rm + merge_keys]
+            self.mm_idcs.append(tuple([fields.index(x) for x in
+                                       multi_match_fields if x in fields]))
+            # prep outer-join empty tuples for appends
+            self.oj_empties.append(tuple([''] * len(fields)))
+        # prep various indices for faster lookup/iteration.  Merged records
+        # are the non-removed fields of the first file's record (keys
+        # included) followed by the value tuples of the others
+        self.key_val_idcs = self.key_idcs(0)
+        self.out_idcs = extract_named_vals(range(len(hmerge[0])), hmerge[0],
+                                           None, rm_keys)
+
+    def key_idcs(self, idx):
+        """
+        Return the positions of the join key fields within a file's records.
+        @param idx 0-based index of the file
+        @return tuple of 0-based field offsets
+        """
+        return extract_named_vals(range(len(self.hmerge[idx])),
+                                  self.hmerge[idx], self.merge_keys)
+
+
+def load_lookup(f, idx, plan, index_dir=None, print_every=1000,
+                key_filter=None):
+    """
+    Build the lookup structure of a single file other than the first.
+    @param f open fileinput object positioned after its header line
+    @param idx 0-based index of the file (the first file being 0)
+    @param plan JoinPlan describing the fields of each file
+    @param index_dir if specified, directory of saved indices to use (see
+           indexed_lookup).  Saved indices are never filtered
+    @param print_every see create_join_dict
+    @param key_filter see create_join_dict
+    @return lookup dictionary (or other lookup structure)
+    """
+    h = plan.hmerge[idx]
+    mm = plan.mm_idcs[idx]
+    if index_dir is not None and f.filename() != "<stdin>":
+        return indexed_lookup(f, h, plan.merge_keys, plan.rm_lists[idx],
+                              plan.delim, index_dir, print_every, mm,
+                              plan.compact)
+    return create_join_dict(f, h, plan.merge_keys, plan.rm_lists[idx],
+                            plan.delim, print_every, mm, key_filter,
+                            plan.compact)
+
+
+def load_lookup_job(idx):
+    """
+    Build the lookup dictionary of a file in a worker process (see
+    load_lookups), using the files and settings in _shared.
+    @param idx 0-based index of the file (the first file being 0)
+    @return the pickled lookup dictionary, or None if the file has a saved
+            index, which can't be passed back and is instead mapped by the
+            caller
+    """
+    lookup = load_lookup(_shared['fs'][idx - 1], idx, _shared['plan'],
+                         _shared['index_dir'], 0)
+    if isinstance(lookup, MappedLookup):
+        lookup.close()
+        return None
+    buf = cStringIO.StringIO()
+    p = cPickle.Pickler(buf, 2)
+    # without a memo pickling is much faster, but interned strings would no
+    # longer be shared once unpickled
+    p.fast = _shared['plan'].compact != 1
+    p.dump(lookup)
+    return buf.getvalue()
+
+
+def load_lookups(fs, plan, index_dir=None, print_every=1000, loaders=1,
+                 names=None):
+    """
+    Build the lookup structure of each file other than the first.  When
+    prescreening, each file only stores the keys present in the lookup of the
+    file before it, so the last lookup holds exactly the keys common to all
+    of them, and the earlier dictionaries are pruned to those keys as well.
+    @param fs list of open fileinput objects of each file other than the
+           first, positioned after their header lines
+    @param plan JoinPlan describing the fields of each file
+    @param index_dir if specified, directory of saved indices to use (see
+           indexed_lookup).  Saved indices are never prescreened
+    @param print_every see create_join_dict
+    @param loaders if greater than 1, build the lookups concurrently in this
+           many worker processes.  Files are then loaded in full and only
+           pruned to their common keys afterwards when prescreening
+    @param names list of the names of the files in fs ("-" for stdin).  Only
+           needed when loaders is greater than 1
+    @return list of lookup dictionaries (or other lookup structures)
+    """
+    lookups = list()
+    order = list()
+    if loaders > 1 and names is not None:
+        # larger files first, so the smaller ones fill in around them.
+        # Workers can't read stdin, so it is left to this process
+        order = sorted([x for x in xrange(1, len(fs) + 1) if
+                        names[x - 1] != "-"],
+                       key=lambda x: -estimate_size(names[x - 1]))
+    if len(order) > 1:
+        # this process loads the largest file itself meanwhile
+        own = order.pop(0)
+        sys.stderr.write("loading %d files on %d processes\n" %
+                         (len(fs), min(loaders - 1, len(order)) + 1))
+        _shared['fs'] = fs
+        _shared['plan'] = plan
+        _shared['index_dir'] = index_dir
+        sys.stdout.flush()
+        pool = Pool(processes=min(loaders - 1, len(order)))
+        pending = pool.map_async(load_lookup_job, order, 1)
+        pool.close()
+        results = dict()
+        results[own] = load_lookup(fs[own - 1], own, plan, index_dir,
+                                   print_every)
+        for idx, res in zip(order, pending.get()):
+            results[idx] = cPickle.loads(res) if res is not None else None
+        pool.join()
+        _shared.clear()
+        for idx, f in enumerate(fs, 1):
+            lookup = results.get(idx)
+            if lookup is None:
+                lookup = load_lookup(f, idx, plan, index_dir, print_every)
+            elif print_every > 0 and idx != own:
+                sys.stderr.write("loaded lookup dictionary from: %s\n" %
+                                 f.filename())
+                report_lookup(f.filename(), lookup)
+            lookups.append(lookup)
+        common = None
+        if plan.prescreen:
+            dicts = [x for x in lookups if isinstance(x, dict)]
+            if len(dicts) > 0:
+                common = set([x for x in min(dicts, key=len) if
+                              all(x in y for y in lookups)])
+    else:
+        for idx, f in enumerate(fs, 1):
+            key_filter = None
+            if plan.prescreen and len(lookups) > 0:
+                key_filter = lookups[-1]
+            lookups.append(load_lookup(f, idx, plan, index_dir, print_every,
+                                       key_filter))
+        common = lookups[-1] if len(lookups) > 0 else None
+    if plan.prescreen and len(lookups) > 1 and common is not None:
+        for d in lookups:
+            if isinstance(d, dict) and d is not common:
+                for key in [x for x in d if x not in common]:
+                    del d[key]
+        if print_every > 0:
+            sys.stderr.write("prescreen: %s keys common to all files\n" %
+                             locale.format("%d", len(common), grouping=True))
+    return lookups
+
+
+def tuple_getter(idcs):
+    """
+    Build a function extracting the values at fixed positions of a sequence.
+    @param idcs 0-based positions of the values to extract
+    @return function taking a sequence and returning a tuple of its values
+    """
+    if len(idcs) == 0:
+        return lambda seq: ()
+    elif len(idcs) == 1:
+        return lambda seq: (seq[idcs[0]],)
+    return operator.itemgetter(*idcs)
+
+
+def probe_lines(lines, lookup_dicts, plan, out=sys.stdout,
+                progress=PROGRESS_INTERVAL, seq=False,
+                buffer_size=OUTPUT_BUFFER):
+    """
+    Join each record of the first file against the lookup dictionaries built
+    from the others, writing the merged records.
+    @param lines iterable of the (newline terminated) records of the first
+           file, excluding its header
+    @param lookup_dicts list containing a dictionary for each other file, as
+           built by create_join_dict
+    @param plan JoinPlan describing the fields of each file
+    @param out open file object to write merged records to
+    @param progress write the line count to stderr at most once every this
+           many seconds.  Set to 0 to write no progress at all
+    @param seq if True each record is prefixed by a sequence number and the
+           delimiter (see partition_lines), which is passed through to the
+           merged record
+    @param buffer_size merged records are collected until they total at
+           least this many bytes, then written to out in a single call.  If
+           0 each record is written as soon as it is merged
+    @return the number of merged records written, less any that were not
+            fully matched
+    """
+    delim = plan.delim
+    get_key_vals = tuple_getter(plan.key_val_idcs)
+    get_out_vals = tuple_getter(plan.out_idcs)
+    key_filter = None
+    if plan.prescreen and len(lookup_dicts) > 0 and len(plan.key_val_idcs) > 0:
+        # keys of the last lookup are common to all (see load_lookups)
+        key_filter = lookup_dicts[-1]
+        max_split = max(plan.key_val_idcs) + 1
+    mm_idcs = plan.mm_idcs
+    multi_match_fn = plan.multi_match_fn
+    merge_count = 0
+    line_count = 0
+    prefix = ""
+    chunks = list()
+    add_chunk = chunks.append
+    pending = 0
+    next_report = time.time() + progress
+    for ln in lines:
+        line_count += 1
+        if (progress > 0 and line_count % PROGRESS_CHECK == 0 and
+           time.time() >= next_report):
+            sys.stderr.write(locale.format("%d", line_count, grouping=True) +
+                             "\r")
+            next_report = time.time() + progress
+        if seq:
+            prefix, ln = ln.split(delim, 1)
+            prefix += delim
+        ln = ln.rstrip('\n')
+        if (key_filter is not None and
+           get_key_vals(ln.split(delim, max_split)) not in key_filter):
+            continue
+        rec = ln.split(delim)
+        key_vals = get_key_vals(rec)
+        vals = get_out_vals(rec)
+        valid_merge = True
+        for idx in xrange(len(lookup_dicts)):
+            if key_vals in lookup_dicts[idx]:
+                if multi_match_fn is None:
+                    (newvals, res) = (lookup_dicts[idx][key_vals][0], True)
+                else:
+                    (newvals, res) = multi_match_fn(lookup_dicts[idx][
+                                                    key_vals],
+                                                    mm_idcs[idx + 1],
+                                                    [rec[x] for x in
+                                                     mm_idcs[0]])
+                vals += newvals
+                if not res:
+                    merge_count -= 1
+            elif plan.outer_join:
+                merge_count -= 1
+                vals += plan.oj_empties[idx]
+            else:
+                valid_merge = False
+                break
+        if valid_merge:
+            merge_count += 1
+            ln = prefix + delim.join(vals) + "\n"
+            add_chunk(ln)
+            pending += len(ln)
+            if pending >= buffer_size:
+                out.write("".join(chunks))
+                del chunks[:]
+                pending = 0
+    out.write("".join(chunks))
+    if progress > 0:
+        sys.stderr.write(locale.format("%d", line_count, grouping=True) +
+                         "\n")
+    return merge_count
+
+
+def estimate_size(fname):
+    """
+    Roughly estimate the memory needed to hold the lookup dictionary built
+    from a file.
+    @param fname name of the file.  May be gzip or bzip2 compressed
+    @return estimated size in bytes.  Files whose size cannot be determined
+            (e.g. stdin) are estimated at 0
+    """
+    try:
+        size = os.path.getsize(fname)
+    except OSError:
+        return 0
+    if os.path.splitext(fname)[1] in (".gz", ".bz2"):
+        size *= COMPRESSION_RATIO
+    return size * MEMORY_RATIO
+
+
+def partition_lines(lines, key_idcs, parts, delim="\t", seq=False, salt=0):
+    """
+    Hash partition records by their join key values into temporary files, so
+    that records sharing a key always land in the same partition.
+    @param lines iterable of the (newline terminated) records to partition
+    @param key_idcs 0-based offsets of the join key fields in each record
+    @param parts number of partitions to create
+    @param delim the field separator
+    @param seq if True prefix each record with its 0-based position in lines
+           followed by the delimiter, so the original order can be restored
+    @param salt mixed into the hash of each key.  Use a different value to
+           split up an existing partition
+    @return list of the partition file names.  The caller is responsible for
+            removing them
+    """
+    names = list()
+    outs = list()
+    for idx in xrange(parts):
+        fd, name = tempfile.mkstemp(prefix="keyed_join_")
+        names.append(name)
+        outs.append(os.fdopen(fd, "w"))
+    max_split = max(key_idcs) + 1 if len(key_idcs) > 0 else 0
+    for pos, ln in enumerate(lines):
+        rec = ln.rstrip('\n').split(delim, max_split)
+        key_vals = tuple([rec[x] for x in key_idcs])
+        out = outs[hash((salt, key_vals) if salt else key_vals) % parts]
+        if seq:
+            out.write("%d%s" % (pos, delim))
+        out.write(ln if ln.endswith('\n') else ln + '\n')
+    for out in outs:
+        out.close()
+    return names
+
+
+def write_batched(lines, out, buffer_size=OUTPUT_BUFFER):
+    """
+    Write lines in chunks of at least buffer_size bytes.
+    @param lines iterable of newline terminated strings
+    @param out open file object to write to
+    @param buffer_size see probe_lines
+    """
+    chunks = list()
+    pending = 0
+    for ln in lines:
+        chunks.append(ln)
+        pending += len(ln)
+        if pending >= buffer_size:
+            out.write("".join(chunks))
+            del chunks[:]
+            pending = 0
+    out.write("".join(chunks))
+
+
+def combine_outputs(names, out, seq=False, delim="\t", keep_seq=False,
+                    buffer_size=OUTPUT_BUFFER):
+    """
+    Write the merged records of several partitions, as created by
+    join_partition.
+    @param names list of the names of the files holding the merged records
+    @param out open file object to write the records to
+    @param seq if True records are prefixed by a sequence number, and are
+           written in sequence order, otherwise in the order of names
+    @param delim the field separator
+    @param keep_seq if True sequence numbers are retained in the records
+           written
+    @param buffer_size see probe_lines
+    """
+    fs = [open(x) for x in names]
+    if seq:
+        lines = (x[1] for x in heapq.merge(*[((int(y.split(delim, 1)[0]), y)
+                                             for y in f) for f in fs]))
+        if not keep_seq:
+            lines = (x.split(delim, 1)[1] for x in lines)
+        write_batched(lines, out, buffer_size)
+    else:
+        for f in fs:
+            shutil.copyfileobj(f, out, max(buffer_size, 1))
+    for f in fs:
+        f.close()
+
+
+def join_partition(job):
+    """
+    Join a single partition of each file, as created by partition_lines.  If
+    the lookup dictionaries for the partition would exceed the memory budget
+    it is partitioned again (using a different hash) and the resulting
+    partitions joined one after another.  Intended to be run in a worker
+    process.
+    @param job 5-tuple containing the list of partition file names (first file
+           first), the JoinPlan, whether records of the first file carry
+           sequence numbers, the memory budget in bytes (0 for no budget) and
+           the number of times the partition has been split so far
+    @return 5-tuple containing the name of the temporary file holding the
+            merged records, the merged record count (see probe_lines), the
+            number of records in the lookup dictionaries, their estimated
+            size in bytes (see lookup_size) and the largest size of those
+            held at once, which is smaller if the partition was split again
+    """
+    names, plan, seq, budget, depth = job
+    size = sum(estimate_size(x) for x in names[1:])
+    if budget > 0 and size > budget and depth < MAX_PARTITION_DEPTH:
+        parts = int(math.ceil(float(size) / budget))
+        subparts = list()
+        outnames = list()
+        count = 0
+        num_recs = 0
+        size = 0
+        peak = 0
+        try:
+            for idx in xrange(len(names)):
+                # sequence numbers are an extra leading field when splitting
+                offset = 1 if seq and idx == 0 else 0
+                with open(names[idx]) as f:
+                    subparts.append(partition_lines(
+                        f, [x + offset for x in plan.key_idcs(idx)], parts,
+                        plan.delim, False, depth + 1))
+            for idx in xrange(parts):
+                outname, sub_count, sub_recs, sub_size, sub_peak = \
+                    join_partition(([x[idx] for x in subparts], plan, seq,
+                                    budget, depth + 1))
+                outnames.append(outname)
+                count += sub_count
+                num_recs += sub_recs
+                size += sub_size
+                peak = max(peak, sub_peak)
+            fd, outname = tempfile.mkstemp(prefix="keyed_join_")
+            with os.fdopen(fd, "w") as out:
+                combine_outputs(outnames, out, seq, plan.delim, True)
+        finally:
+            for name in chain(chain(*subparts), outnames):
+                os.remove(name)
+        return (outname, count, num_recs, size, peak)
+    fs = [fileinput.FileInput(x) for x in names[1:]]
+    lookup_dicts = load_lookups(fs, plan, None, 0)
+    for f in fs:
+        f.close()
+    num_recs = 0
+    size = 0
+    for d in lookup_dicts:
+        d_recs, d_size = lookup_size(d)
+        num_recs += d_recs
+        size += d_size
+    fd, outname = tempfile.mkstemp(prefix="keyed_join_")
+    with open(names[0]) as f:
+        with os.fdopen(fd, "w") as out:
+            count = probe_lines(f, lookup_dicts, plan, out, 0, seq)
+    return (outname, count, num_recs, size, size)
+
+
+def join_partitioned(fs, plan, parts, cores=1, ordered=False, budget=0,
+                     out=sys.stdout, buffer_size=OUTPUT_BUFFER):
+    """
+    Hash partition every file by join key, join the matching partitions
+    (in parallel if requested) and write the combined results.
+    @param fs list of open fileinput objects, first file first, positioned
+           after their header lines
+    @param plan JoinPlan describing the fields of each file
+    @param parts number of partitions to split the files into
+    @param cores number of worker processes joining partitions
+    @param ordered if True merged records are written in the order of the
+           first file, otherwise grouped by partition
+    @param budget memory budget in bytes for joining a single partition, or
+           0 for no budget (see join_partition)
+    @param out open file object to write merged records to
+    @param buffer_size see probe_lines
+    @return the merged record count (see probe_lines)
+    """
+    parts_names = list()
+    outnames = list()
+    merge_count = 0
+    try:
+        for idx in xrange(len(fs)):
+            sys.stderr.write("partitioning: %s\n" % fs[idx].filename())
+            parts_names.append(partition_lines(fs[idx], plan.key_idcs(idx),
+                                               parts, plan.delim,
+                                               ordered and idx == 0))
+        sys.stderr.write("joining %d partitions on %d cores\n" %
+                         (parts, cores))
+        jobs = [([x[idx] for x in parts_names], plan, ordered, budget, 0)
+                for idx in xrange(parts)]
+        if cores > 1:
+            out.flush()
+            pool = Pool(processes=cores)
+            results = pool.imap(join_partition, jobs)
+        else:
+            results = imap(join_partition, jobs)
+        num_recs = 0
+        max_size = 0
+        total_size = 0
+        for outname, count, part_recs, part_size, part_peak in results:
+            outnames.append(outname)
+            merge_count += count
+            num_recs += part_recs
+            max_size = max(max_size, part_peak)
+            total_size += part_size
+        if cores > 1:
+            pool.close()
+            pool.join()
+        sys.stderr.write("partition lookups: %s records, ~%s bytes/record, "
+                         "largest ~%s bytes\n" %
+                         (locale.format("%d", num_recs, grouping=True),
+                          locale.format("%d", total_size // max(num_recs, 1),
+                                        grouping=True),
+                          locale.format("%d", max_size, grouping=True)))
+        combine_outputs(outnames, out, ordered, plan.delim, False,
+                        buffer_size)
+    finally:
+        for name in chain(chain(*parts_names), outnames):
+            os.remove(name)
+    return merge_count
+
+
 def join_files(files, keys=None, mv=None, rm=None, delim="\t",
                ignore_case=False, outer_join=False,
-               multi_match_fn=None, multi_match_fields=[]):
+               multi_match_fn=None, multi_match_fields=[], cores=1,
+               ordered=False, budget=0, sort_merge=False, index_dir=None,
+               prescreen=False, keep=None, compact=0, loaders=1,
+               buffer_size=OUTPUT_BUFFER):
     """
     Merge the named files.
     @param files List of names of the file to read from.  We will also
@@ -318,11 +1582,51 @@ def join_files(files, keys=None, mv=None, rm=None, delim="\t",
            first item found.
     @param multi_match_fields tuple listing the fields to sort the multi match
            tuples by
+    @param cores if greater than 1, hash partition the files by key and join
+           the partitions in parallel on this many cores (see
+           join_partitioned).  Defaults to 1
+    @param ordered when joining in parallel, should merged records be written
+           in the order of the first file?  Defaults to False
+    @param budget if greater than 0, the number of megabytes of memory the
+           lookup dictionaries may use.  If they are estimated to need more
+           the files are hash partitioned to disk and joined partition by
+           partition (each core getting an equal share of the budget).
+           Merged records are then still written in the order of the first
+           file, unless joining in parallel without ordered.  Defaults to 0
+    @param sort_merge if True every file is assumed to be sorted by its join
+           key values and they are merge joined in a single pass, holding
+           only the records of the current key of each file in memory (see
+           SortedRunLookup).  cores and budget are then ignored.  Defaults
+           to False
+    @param index_dir if specified, the lookup dictionary of each file other
+           than the first is saved as an index in this directory, and saved
+           indices of unchanged files are memory mapped instead (see
+           indexed_lookup).  Only used when the join isn't partitioned or
+           sort merged.  Defaults to None
+    @param prescreen for inner joins, skip storing records of files whose
+           keys can't be matched in the files loaded before them, and reject
+           unmatchable records of the first file before fully splitting them
+           (see load_lookups).  Defaults to False
+    @param keep if specified, list of the only non-key field names of the
+           files other than the first to store and write to the merged
+           output.  Multi-match fields are stored regardless.  Defaults to
+           None, keeping all fields not in rm
+    @param compact if 1, store lookup dictionaries compactly by interning
+           repeated strings and storing single records without a list.  If
+           2, additionally pack the values of all records into a single
+           buffer (see create_join_dict).  Defaults to 0
+    @param loaders if greater than 1, the files other than the first are
+           loaded concurrently in up to this many processes (see
+           load_lookups).  Defaults to 1
+    @param buffer_size number of bytes of merged records to collect before
+           writing them to stdout in a single call, or 0 to write each as
+           soon as it is merged (see probe_lines).  Defaults to
+           OUTPUT_BUFFER
     @return nothing (results are printed to stdout)
     @throws EmptyStdinError if nothing is waiting at stdin and no other files
             are specified.
+    @throws InputOrderError if sort_merge is set and a file is not sorted
     """
-    print_every = 1000
     # open each file, read first row to get headers
     if (files is None or len(files) == 0 or files[0] == "-") and os.isatty(0):
         raise EmptyStdinError("stdin empty")
@@ -356,91 +1660,52 @@ def join_files(files, keys=None, mv=None, rm=None, delim="\t",
     rm_keys = [x.lower() for x in rm] if ignore_case and rm is not None else rm
     if rm_keys is None:
         rm_keys = []
-    # remove non-keep columns, read in all files but first, creating dicts
-    fh_tuples = zip(fs, hmerge)
-    lookup_dicts = [create_join_dict(f, h, merge_keys, rm_keys, delim)
-                    for (f, h) in fh_tuples[1:]]
+    keep_fields = keep
+    if ignore_case and keep is not None:
+        keep_fields = [x.lower() for x in keep]
+    plan = JoinPlan(hmerge, merge_keys, rm_keys, delim, outer_join,
+                    multi_match_fn, multi_match_fields, prescreen,
+                    keep_fields, compact)
+    parts = max(cores, 1) if not sort_merge else 1
+    budget = budget * 2 ** 20 / parts if not sort_merge else 0
+    if budget > 0:
+        size = sum(estimate_size(x) for x in files[1:])
+        sys.stderr.write("estimated lookup dictionary size: %s bytes\n" %
+                         locale.format("%d", size, grouping=True))
+        if size > budget:
+            parts = max(parts, int(math.ceil(float(size) / budget)))
+    if sort_merge:
+        lookup_dicts = [SortedRunLookup(sf, sh, merge_keys, srm, delim, smm)
+                        for (sf, sh, srm, smm) in zip(fs, hmerge,
+                                                      plan.rm_lists,
+                                                      plan.mm_idcs)[1:]]
+    elif parts <= 1:
+        # remove non-keep columns, read in all files but first, creating dicts
+        lookup_dicts = load_lookups(fs[1:], plan, index_dir, 1000, loaders,
+                                    files[1:])
     # prepare header
     hdr = []
     for idx in xrange(len(hdrs)):
         for h_idx in xrange(len(hdrs[idx])):
-            if (hmerge[idx][h_idx] not in rm_keys and (idx == 0 or
+            if (hmerge[idx][h_idx] not in plan.rm_lists[idx] and (idx == 0 or
                hmerge[idx][h_idx] not in merge_keys)):
                 val = hdrs[idx][h_idx]
                 if idx == 0 and val in multi_match_fields:
                     val = "LEFT_MM_" + val
                 hdr.append(val)
     print delim.join(hdr)
-    # get multi-match field indices
-    mm_idcs = [None] * len(hmerge)
-    for idx in xrange(len(mm_idcs)):
-        mm_idcs[idx] = tuple([hmerge[idx].index(x) for x in multi_match_fields
-                              if x in hmerge[idx]])
     if outer_join:
-        # prep outer-join empty tuples for appends
-        oj_empties = []
-        for idx in range(len(lookup_dicts)):
-            num = len([x for x in hmerge[idx+1]
-                       if x not in rm_keys + merge_keys])
-            oj_empties.append(tuple([''] * num))
-        sys.stderr.write("oj_empties: %s\n" % str(oj_empties))
-    # prep various indices for faster lookup/iteration
-    first_fields = extract_named_vals(hmerge[0], hmerge[0], None,
-                                      merge_keys + rm_keys)
-    key_val_idcs = extract_named_vals(range(len(hmerge[0])), hmerge[0],
-                                      merge_keys)
-    val_idcs = extract_named_vals(range(len(hmerge[0])), hmerge[0],
-                                  first_fields)
-    # iterate through lines of first file, printing details as required
-    sys.stderr.write("merging against lines of %s\n" % fs[0].filename())
+        sys.stderr.write("oj_empties: %s\n" % str(plan.oj_empties))
     merge_count = 1  # +1 for the header
-    for ln in fs[0]:
-        if fs[0].filelineno() % print_every == 0:
-            sys.stderr.write(locale.format("%d", fs[0].filelineno(),
-                             grouping=True) + "\r")
-        rec = ln.rstrip('\n').split(delim)
-        key_vals = tuple([rec[x] for x in key_val_idcs])
-        vals = tuple([rec[x] for x in val_idcs])
-        valid_merge = True
-        for idx in xrange(len(lookup_dicts)):
-            if key_vals in lookup_dicts[idx]:
-                if multi_match_fn is None:
-                    (newvals, res) = (lookup_dicts[idx][key_vals][0], True)
-                else:
-                    (newvals, res) = multi_match_fn(lookup_dicts[idx][
-                                                    key_vals],
-                                                    mm_idcs[idx],
-                                                    [rec[x] for x in
-                                                     mm_idcs[0]])
-                vals += newvals
-                if not res:
-                    merge_count -= 1
-            elif outer_join:
-                merge_count -= 1
-                vals += oj_empties[idx]
-            else:
-                valid_merge = False
-                break
-        if valid_merge:
-            merge_count += 1
-            val_idx = 0
-            ord_vals = []
-            first_h_list = True
-            for h_list in hmerge:
-                for h in h_list:
-                    if first_h_list:
-                        try:
-                            ord_vals.append(key_vals[merge_keys.index(h)])
-                        except ValueError:
-                            ord_vals.append(vals[val_idx])
-                            val_idx += 1
-                    else:
-                        if h not in merge_keys:
-                            ord_vals.append(vals[val_idx])
-                            val_idx += 1
-                first_h_list = False
-            print delim.join(ord_vals)
-    sys.stderr.write('\n')
+    if parts > 1:
+        merge_count += join_partitioned(fs, plan, parts, cores,
+                                        ordered or cores <= 1, budget,
+                                        sys.stdout, buffer_size)
+    else:
+        # iterate through lines of first file, printing details as required
+        sys.stderr.write("merging against lines of %s\n" % fs[0].filename())
+        merge_count += probe_lines(fs[0], lookup_dicts, plan, sys.stdout,
+                                   PROGRESS_INTERVAL, False, buffer_size)
     sys.stderr.write("final number of merged records: " +
                      locale.format("%d", merge_count, grouping=True) + "\n")
 
@@ -477,10 +1742,16 @@ def main():
                                                             args.geconstraint,
                                                             args.closest)
         join_files(args.file, args.key, args.mv, args.rm, args.delim,
-                   args.ignore_case, args.left_outer, multi_fn, multi_flds)
+                   args.ignore_case, args.left_outer, multi_fn, multi_flds,
+                   args.cores, args.ordered, args.budget, args.sorted,
+                   args.index, args.prescreen, args.keep, args.compact,
+                   args.loaders, args.buffer)
     except EmptyStdinError:
         print("warning: no files specified and nothing waiting at stdin")
         parser.print_help()
+    except InputOrderError as e:
+        sys.stderr.write("\nerror: unsorted input: %s\n" % str(e))
+        sys.exit(4)
 
 
 if __name__ == '__main__':
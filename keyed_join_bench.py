@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+""" @namespace keyed_join_bench
+Time keyed_join's probe loop on synthetic data joined against an in-memory
+lookup.  Write per-row throughput figures to stdout.
+"""
+
+## file version
+__version__ = "1.1.0"
+
+import os
+import re
+import time
+import random
+import tempfile
+import argparse
+import keyed_join
+
+
+def prep_arg_parser():
+    """
+    Define any command line arguments passed to the script.
+    @return argparse.ArgumentParser instance
+    """
+    p = argparse.ArgumentParser(description=re.sub("@.*\n", "", __doc__),
+                                formatter_class=(
+                                    argparse.ArgumentDefaultsHelpFormatter))
+    p.add_argument("-V", "--version", dest="version",
+                   help="display released version number of this script",
+                   action="version", version="%(prog)s: " + __version__)
+    p.add_argument("-m", "--mode", choices=["assembly", "stream"],
+                   default="assembly",
+                   help="%s %s %s %s %s %s" % ("compare the legacy and",
+                                               "precompiled row assembly on",
+                                               "records held in memory",
+                                               "(assembly), or stream a left",
+                                               "file from disk with and",
+                                               "without output batching "
+                                               "(stream)"))
+    p.add_argument("-n", "--rows", type=int,
+                   help="%s %s %s" % ("number of records in the first",
+                                      "(left) file.  Defaults to 100000 for",
+                                      "assembly and 10000000 for stream"))
+    p.add_argument("-w", "--width", type=int,
+                   help="%s %s %s" % ("number of fields in each left",
+                                      "record.  Defaults to 200 for assembly",
+                                      "and 20 for stream"))
+    p.add_argument("-W", "--rwidth", type=int, default=50,
+                   help="number of non-key fields in each lookup record")
+    p.add_argument("-u", "--keys", type=int, default=10000,
+                   help="number of distinct join key values")
+    p.add_argument("-s", "--seed", type=int, default=0,
+                   help="seed value for random number generator")
+    p.add_argument("-b", "--buffer", type=int,
+                   default=keyed_join.OUTPUT_BUFFER, metavar="BYTES",
+                   help="output buffer size of the batched stream loop")
+    return p
+
+
+def make_lines(num_rows, width, num_keys, delim="\t"):
+    """
+    Generate synthetic left records, keyed on their first field.
+    @param num_rows number of records
+    @param width number of fields in each record (at least 2)
+    @param num_keys number of distinct key values
+    @param delim the field separator
+    @return iterator over the newline terminated records
+    """
+    for idx in xrange(num_rows):
+        yield delim.join(["k%d" % random.randrange(num_keys)] +
+                         [str(idx)] * (width - 1)) + "\n"
+
+
+def make_join(num_rows, width, rwidth, num_keys, delim="\t"):
+    """
+    Create synthetic records to join, on a single key field.
+    @param num_rows number of left records
+    @param width number of fields in each left record (at least 2)
+    @param rwidth number of non-key fields in each lookup record
+    @param num_keys number of distinct key values, all present in the lookup
+    @param delim the field separator
+    @return 3-tuple containing the list of left lines, the lookup dictionary
+            and the JoinPlan
+    """
+    lhdr = ["key"] + ["l%d" % x for x in xrange(1, width)]
+    rhdr = ["key"] + ["r%d" % x for x in xrange(rwidth)]
+    lines = list(make_lines(num_rows, width, num_keys, delim))
+    lookup = dict((("k%d" % x,), [tuple(["v%d" % x] * rwidth)])
+                  for x in xrange(num_keys))
+    plan = keyed_join.JoinPlan([lhdr, rhdr], ["key"], [], delim)
+    return (lines, lookup, plan)
+
+
+def legacy_probe_lines(lines, lookup_dicts, plan, out):
+    """
+    The probe loop as it was before JoinPlan precompiled the row assembly:
+    each merged record is reassembled by walking every header field.  Only
+    the take-first, inner join case is reproduced.
+    @param lines iterable of the records of the first file
+    @param lookup_dicts list of lookup dictionaries
+    @param plan JoinPlan describing the fields of each file
+    @param out open file object to write merged records to
+    @return the number of merged records written
+    """
+    delim = plan.delim
+    merge_keys = plan.merge_keys
+    key_val_idcs = plan.key_val_idcs
+    val_idcs = [x for x in xrange(len(plan.hmerge[0])) if x not in
+                key_val_idcs]
+    merge_count = 0
+    for ln in lines:
+        rec = ln.rstrip('\n').split(delim)
+        key_vals = tuple([rec[x] for x in key_val_idcs])
+        vals = tuple([rec[x] for x in val_idcs])
+        valid_merge = True
+        for idx in xrange(len(lookup_dicts)):
+            if key_vals in lookup_dicts[idx]:
+                vals += lookup_dicts[idx][key_vals][0]
+            else:
+                valid_merge = False
+                break
+        if valid_merge:
+            merge_count += 1
+            val_idx = 0
+            ord_vals = []
+            first_h_list = True
+            for h_list in plan.hmerge:
+                for h in h_list:
+                    if first_h_list:
+                        try:
+                            ord_vals.append(key_vals[merge_keys.index(h)])
+                        except ValueError:
+                            ord_vals.append(vals[val_idx])
+                            val_idx += 1
+                    else:
+                        if h not in merge_keys:
+                            ord_vals.append(vals[val_idx])
+                            val_idx += 1
+                first_h_list = False
+            out.write(delim.join(ord_vals) + "\n")
+    return merge_count
+
+
+def time_probe(fn, lines, lookup, plan):
+    """
+    Time a single pass of a probe loop function over the left records.
+    @param fn function called as fn(lines, lookup_dicts, plan, out)
+    @param lines iterable of left records
+    @param lookup lookup dictionary
+    @param plan JoinPlan
+    @return 2-tuple containing elapsed seconds and merged record count
+    """
+    with open(os.devnull, "w") as out:
+        start = time.time()
+        count = fn(lines, [lookup], plan, out)
+        return (time.time() - start, count)
+
+
+def bench_assembly(args):
+    """
+    Compare the legacy and precompiled row assembly, printing rows per second
+    for each.
+    @param args parsed command line arguments
+    """
+    lines, lookup, plan = make_join(args.rows, args.width, args.rwidth,
+                                    args.keys)
+    print "\t".join(["loop", "rows", "seconds", "rows/sec"])
+    for name, fn in [("legacy", legacy_probe_lines),
+                     ("precompiled", lambda l, d, p, o:
+                      keyed_join.probe_lines(l, d, p, o, 0))]:
+        secs, count = time_probe(fn, lines, lookup, plan)
+        print "\t".join([name, str(count), "%.3f" % secs,
+                         "%.0f" % (count / secs)])
+
+
+def bench_stream(args):
+    """
+    Write a left file to disk and time joining it, record by record from
+    disk, with each merged record written as soon as it is merged and with
+    batched output, printing rows per second for each.
+    @param args parsed command line arguments
+    """
+    _, lookup, plan = make_join(0, args.width, args.rwidth, args.keys)
+    fd, name = tempfile.mkstemp(prefix="keyed_join_bench_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(make_lines(args.rows, args.width, args.keys))
+        print "\t".join(["loop", "rows", "seconds", "rows/sec"])
+        for label, size in [("unbuffered", 0), ("batched", args.buffer)]:
+            with open(name) as f:
+                secs, count = time_probe(lambda l, d, p, o:
+                                         keyed_join.probe_lines(l, d, p, o, 0,
+                                                                False, size),
+                                         f, lookup, plan)
+            print "\t".join([label, str(count), "%.3f" % secs,
+                             "%.0f" % (count / secs)])
+    finally:
+        os.remove(name)
+
+
+def main():
+    """ Point of code entry. """
+    args = prep_arg_parser().parse_args()
+    random.seed(args.seed)
+    if args.mode == "stream":
+        args.rows = 10000000 if args.rows is None else args.rows
+        args.width = 20 if args.width is None else args.width
+        bench_stream(args)
+    else:
+        args.rows = 100000 if args.rows is None else args.rows
+        args.width = 200 if args.width is None else args.width
+        bench_assembly(args)
+
+
+if __name__ == '__main__':
+    main()
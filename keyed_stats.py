@@ -4,21 +4,37 @@ Construct indexed tables of statistics according to various types of keys
 """
 
 ## file version
-__version__ = "1.0.3"
+__version__ = "1.13.0"
 
 import sys
 import os
 import re
+import zlib
+import base64
+import cPickle
+import json
+import mmap
+import struct
+import heapq
+import tempfile
+import math
+import random
 import argparse
 import fileinput
 import datetime
 import string
 import signal
 import locale
+from operator import itemgetter
+from array import array
 from collections import defaultdict
 from dateutil.relativedelta import relativedelta
-from itertools import product
+from itertools import product, chain, groupby, imap
 from multiprocessing import Pool
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def signal_handler(signal, frame):
@@ -32,6 +48,29 @@ signal.signal(signal.SIGPIPE, signal_handler)
 locale.setlocale(locale.LC_ALL, 'en_US')
 
 
+## suffix identifying the sketch file belonging to a stats table
+SKETCH_SUFFIX = ".sketch"
+
+## maximum number of keysets whose stats rows are calculated (and written)
+## at once
+STATS_RANGE = 10000
+
+## magic number identifying a binary stats table (see BinaryTableWriter)
+BINARY_MAGIC = "KSB1"
+
+## number of rows of a binary table decoded at once when merging
+BINARY_BLOCK = 4096
+
+## version of the serialized form of stats lists (see StreamStatList.to_bytes)
+STATS_FORMAT = 1
+
+## characters a value float() can convert may start with
+FLOAT_CHARS = frozenset("0123456789+-.nNiI \t\n\r\v\f")
+
+## stats, sorted keysets and args inherited by calc_stats_range workers
+_shared = dict()
+
+
 class EmptyStdinError(Exception):
     """
     Raised when user specifies reading from STDIN but no data waiting
@@ -55,40 +94,190 @@ class FieldNotFoundError(Exception):
         return(repr(self.value))
 
 
+class StateMismatchError(Exception):
+    """
+    Raised when a saved state file was built with different settings than
+    those it is being updated with.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return(repr(self.value))
+
+
+class StatsFormatError(Exception):
+    """
+    Raised when serialized stats (a sketch or saved state) are of an unknown
+    version or otherwise can't be decoded.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return(repr(self.value))
+
+
+class TableOrderError(Exception):
+    """
+    Raised when a table expected to be sorted by key is not.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return(repr(self.value))
+
+
+def latin1_bytes(val):
+    """
+    Convert a string decoded from JSON back to the bytes it was written from
+    (as Latin-1, see StreamStatList.to_bytes).
+    @param val the decoded value
+    @return val, as a str if it was unicode
+    """
+    return val.encode('latin-1') if isinstance(val, unicode) else val
+
+
+def split_strs(items, key=None):
+    """
+    Separate the strings among a collection of values from the others.
+    @param items iterable of values (or of items holding them)
+    @param key function returning the value of an item.  Defaults to the
+           item itself
+    @return 2-item list: the list of items whose value is not a string,
+            then the list of those whose value is
+    """
+    res = [list(), list()]
+    for item in items:
+        res[isinstance(item if key is None else key(item), str)].append(item)
+    return res
+
+
 class StatList:
     """
-    A collection of KeyedRecords upon which statistics can be computed.
+    A collection of KeyedRecord values upon which statistics can be computed.
+    Only the values are retained: numeric ones packed into a typed array,
+    and any others (interned where possible) in a separate list.  Numbers
+    order before all other values, so the two together form the sorted
+    sequence of values.
     """
     def __init__(self):
-        self.krs = list()
+        self.nums = array('d')
+        self.others = list()
         self.is_sorted = True
 
+    @classmethod
+    def estimate_bytes(cls, keysets, values):
+        """
+        Roughly estimate the memory taken by a stats dictionary of these
+        lists, as measured on 64 bit CPython 2.7: about 750 bytes for each
+        keyset (its tuple, dictionary entry and empty list) plus 8 for each
+        value added (a packed number, or a reference to an interned string).
+        @param keysets number of keysets in the dictionary
+        @param values total number of values added to its lists
+        @return estimated size in bytes
+        """
+        return 750 * keysets + 8 * values
+
     def add(self, keyed_rec):
         """
         Add a new KeyedRecord to this stats list.
-        @param keyed_rec a KeyedRecord instance.
+        @param keyed_rec a KeyedRecord instance.  Only its value is retained.
         """
-        self.krs.append(keyed_rec)
+        val = keyed_rec.val
+        if isinstance(val, (int, float)):
+            self.nums.append(val)
+        else:
+            self.others.append(intern(val) if isinstance(val, str) else val)
         self.is_sorted = False
 
+    def merge(self, other):
+        """
+        Fold the values of another StatList into this one.
+        @param other StatList instance.  It is left unchanged.
+        """
+        self.nums.extend(other.nums)
+        self.others.extend(other.others)
+        self.is_sorted = False
+
+    def to_bytes(self):
+        """
+        Serialize this list to a binary string: a 4 byte little-endian
+        length, the JSON encoding of STATS_FORMAT and the non-numeric values
+        (see StreamStatList.to_bytes), then the numeric values as
+        little-endian float64s.
+        @return string encoding
+        """
+        others = json.dumps([STATS_FORMAT, self.others], encoding='latin-1',
+                            separators=(',', ':'))
+        nums = self.nums
+        if sys.byteorder == 'big':
+            nums = array('d', nums)
+            nums.byteswap()
+        return struct.pack('<I', len(others)) + others + nums.tostring()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Reconstruct a list from the output of to_bytes.
+        @param data string encoding
+        @return instance of this class
+        @throws StatsFormatError if data is not in the current format
+        """
+        res = cls()
+        try:
+            size = struct.unpack_from('<I', data)[0]
+            fields = json.loads(data[4:4 + size])
+            if fields[0] != STATS_FORMAT:
+                raise StatsFormatError("version %s, expected %d" %
+                                       (fields[0], STATS_FORMAT))
+            res.others = [intern(latin1_bytes(x)) for x in fields[1]]
+            res.nums.fromstring(data[4 + size:])
+        except (struct.error, ValueError, TypeError, IndexError):
+            raise StatsFormatError("not a serialized %s" % cls.__name__)
+        if sys.byteorder == 'big':
+            res.nums.byteswap()
+        res.is_sorted = len(res.nums) + len(res.others) == 0
+        return res
+
+    def sort(self):
+        """
+        Ensure the values held are in sorted order.
+        """
+        if not self.is_sorted:
+            self.nums = array('d', sorted(self.nums))
+            self.others.sort()
+            self.is_sorted = True
+
+    def value_at(self, idx):
+        """
+        Return the value at the given position of the (sorted) values.
+        @param idx 0-based index into the values
+        @return the value at that position
+        """
+        if idx < len(self.nums):
+            return self.nums[idx]
+        return self.others[idx - len(self.nums)]
+
     def get_count(self):
         """
         Return the number of items currently in this list.
         @return int specifying the item count
         """
-        return len(self.krs)
+        return len(self.nums) + len(self.others)
 
     def get_min(self):
         """
         Return the minimum value of the items currently in this list.
         @return float specifying the min value.
         """
-        res = float('inf')
-        for kr in self.krs:
-            if isinstance(kr.val, (int, float)):
-                res = min(res, kr.val)
-        if res == float('inf'):
-            res = float('nan')
+        if len(self.nums) == 0:
+            return float('nan')
+        res = min(self.nums)
+        if res != res:
+            # a leading NaN (missing value) is never replaced, so skip them
+            res = min([x for x in self.nums if x == x] or [float('nan')])
         return res
 
     def get_max(self):
@@ -96,12 +285,11 @@ class StatList:
         Return the maximum value of the items currently in this list.
         @return float specifying the min value.
         """
-        res = float('-inf')
-        for kr in self.krs:
-            if isinstance(kr.val, (int, float)):
-                res = max(res, kr.val)
-        if res == float('-inf'):
-            res = float('nan')
+        if len(self.nums) == 0:
+            return float('nan')
+        res = max(self.nums)
+        if res != res:
+            res = max([x for x in self.nums if x == x] or [float('nan')])
         return res
 
     def get_mean(self):
@@ -109,16 +297,9 @@ class StatList:
         Return the average of the numeric values in this list.
         @return float specifying average value.
         """
-        tot = 0.0
-        count = 0
-        res = float('nan')
-        for kr in self.krs:
-            if isinstance(kr.val, (int, float)):
-                tot += kr.val
-                count += 1
-        if count > 0:
-            res = tot / count
-        return res
+        if len(self.nums) == 0:
+            return float('nan')
+        return sum(self.nums, 0.0) / len(self.nums)
 
     def get_mode(self):
         """
@@ -127,20 +308,18 @@ class StatList:
                 will be broken by returning the smallest such most frequent
                 item.
         """
-        if not self.is_sorted:
-            self.krs.sort(key=lambda kr: kr.val)
-            self.is_sorted = True
+        self.sort()
         val = None
         count = 0
         max_count = -1
         max_val = None
-        for kr in self.krs:
-            if kr.val != val:
+        for item in chain(self.nums, self.others):
+            if item != val:
                 if count > max_count:
                     max_count = count
                     max_val = val
                 count = 0
-                val = kr.val
+                val = item
             count += 1
         # ensure we compare the very last item
         if count > max_count:
@@ -158,13 +337,11 @@ class StatList:
                examined
         @return list of values corresponding to the percentiles.
         """
-        if not self.is_sorted:
-            self.krs.sort(key=lambda kr: kr.val)
-            self.is_sorted = True
+        self.sort()
         num_recs = self.get_count()
         if only_numeric:
             idx = 0
-            while idx < num_recs and self.krs[idx].val in [None, '']:
+            while idx < num_recs and self.value_at(idx) in [None, '']:
                 idx += 1
             if idx == num_recs:
                 # all indices are invalid/missing
@@ -174,13 +351,598 @@ class StatList:
         else:
             percentile_idcs = [int(float(x) / 100 * num_recs) for x in
                                percentiles]
-        return [self.krs[x].val for x in percentile_idcs]
+        return [self.value_at(x) for x in percentile_idcs]
 
 
-class KeyedRecord:
+class NumpyStatList(StatList):
+    """
+    StatList variant computing its statistics with vectorized NumPy
+    operations over a zero-copy view of the numeric values, rather than
+    Python loops.  Intended for keysets holding very many values.
+    """
+    def view(self):
+        """
+        Return the numeric values as a NumPy array sharing their memory.
+        @return numpy.ndarray of float64 values
+        """
+        return np.frombuffer(self.nums, dtype=np.float64)
+
+    def get_min(self):
+        """
+        Return the minimum value of the items currently in this list.
+        @return float specifying the min value.
+        """
+        vals = self.view()
+        if len(vals) == 0 or np.isnan(vals).all():
+            return float('nan')
+        return float(np.nanmin(vals))
+
+    def get_max(self):
+        """
+        Return the maximum value of the items currently in this list.
+        @return float specifying the max value.
+        """
+        vals = self.view()
+        if len(vals) == 0 or np.isnan(vals).all():
+            return float('nan')
+        return float(np.nanmax(vals))
+
+    def get_mean(self):
+        """
+        Return the average of the numeric values in this list.
+        @return float specifying average value.
+        """
+        if len(self.nums) == 0:
+            return float('nan')
+        return float(self.view().mean())
+
+    def get_mode(self):
+        """
+        Determine the most frequently occuring value in this list.
+        @return most frequent value and count as a tuple.  Ties are broken by
+                returning the smallest such most frequent item.
+        """
+        if len(self.nums) == 0:
+            return StatList.get_mode(self)
+        vals, counts = np.unique(self.view(), return_counts=True)
+        idx = counts.argmax()
+        max_val = float(vals[idx])
+        max_count = int(counts[idx])
+        self.others.sort()
+        for val, grp in groupby(self.others):
+            count = sum(1 for x in grp)
+            if count > max_count:
+                max_val = val
+                max_count = count
+        return (max_val, max_count)
+
+    def get_percentiles(self, percentiles=[50], only_numeric=False):
+        """
+        Determine and return the specified percentiles, selecting all of them
+        from the numeric values with a single partial sort.
+        @param percentiles list of numeric values [1-99] specifying
+               percentile(s) to compute.  Defaults to median i.e. [50]
+        @param only_numeric if True only numeric values in the list are
+               examined
+        @return list of values corresponding to the percentiles.
+        """
+        num_nums = len(self.nums)
+        if num_nums == 0:
+            # nothing to vectorize, and leading missing values may need
+            # skipping
+            return StatList.get_percentiles(self, percentiles, only_numeric)
+        num_recs = self.get_count()
+        idcs = [int(float(x) / 100 * num_recs) for x in percentiles]
+        num_idcs = sorted(set(x for x in idcs if x < num_nums))
+        if len(num_idcs) > 0:
+            part = np.partition(self.view(), num_idcs)
+        if any(x >= num_nums for x in idcs):
+            self.others.sort()
+        return [float(part[x]) if x < num_nums else
+                self.others[x - num_nums] for x in idcs]
+
+
+class ModeSketch:
+    """
+    Bounded size frequency counter used to approximate the most common value
+    of a stream (the Space-Saving algorithm of Metwally et al. 2005).  Counts
+    are exact until more than size distinct values have been seen, after
+    which the least frequent value is evicted to make room for each new one.
+    Once full, values are also grouped into buckets by count (the "stream
+    summary" of the paper), so the least frequent value is found without
+    scanning and each add costs O(1).
+    """
+    def __init__(self, size=64):
+        """
+        Create a new sketch.
+        @param size maximum number of distinct values to track.
+        """
+        self.size = size
+        self.counts = dict()
+        self.buckets = None
+        self.min_count = 0
+
+    def add(self, val, count=1):
+        """
+        Record count more occurrences of val.
+        @param val the value to count
+        @param count number of occurrences to add.  Defaults to 1
+        """
+        counts = self.counts
+        if val in counts:
+            old = counts[val]
+            counts[val] = old + count
+            if self.buckets is not None:
+                self.move(val, old, old + count)
+        elif len(counts) < self.size:
+            counts[val] = count
+            if self.buckets is not None:
+                self.move(val, None, count)
+        else:
+            if self.buckets is None:
+                self.fill_buckets()
+            buckets = self.buckets
+            min_count = self.min_count
+            group = buckets[min_count]
+            del counts[group.pop()]
+            counts[val] = min_count + count
+            buckets[min_count + count].add(val)
+            if not group:
+                del buckets[min_count]
+                self.min_count = (min_count + 1 if count == 1 else
+                                  min(buckets))
+
+    def fill_buckets(self):
+        """
+        Group the values tracked into buckets by their count.
+        """
+        self.buckets = defaultdict(set)
+        for val, count in self.counts.iteritems():
+            self.buckets[count].add(val)
+        self.min_count = min(self.buckets) if self.buckets else 0
+
+    def move(self, val, old, new):
+        """
+        Move a value from one count bucket to another, keeping track of the
+        smallest count.
+        @param val the value
+        @param old its previous count, or None if it wasn't tracked
+        @param new its new count
+        """
+        buckets = self.buckets
+        buckets[new].add(val)
+        if old is None:
+            self.min_count = min(self.min_count, new)
+            return
+        group = buckets[old]
+        group.discard(val)
+        if not group:
+            del buckets[old]
+            if old == self.min_count:
+                self.min_count = new if new == old + 1 else min(buckets)
+
+    def merge(self, other):
+        """
+        Fold the counts of another sketch into this one, keeping only the
+        size most frequent values.
+        @param other ModeSketch instance.  It is left unchanged.
+        """
+        for val, count in other.counts.iteritems():
+            self.counts[val] = self.counts.get(val, 0) + count
+        if len(self.counts) > self.size:
+            keep = sorted(self.counts.iteritems(), key=lambda x: -x[1])
+            self.counts = dict(keep[:self.size])
+        # regrouped when next needed
+        self.buckets = None
+
+    def get_mode(self):
+        """
+        Return the (approximate) most frequent value and its count.
+        @return value and count as a tuple.  Ties are broken by returning the
+                smallest such value, as in StatList.get_mode
+        """
+        max_val = None
+        max_count = 0
+        for val in sorted(self.counts):
+            if self.counts[val] > max_count:
+                max_val = val
+                max_count = self.counts[val]
+        return (max_val, max_count)
+
+
+class QuantileSketch:
+    """
+    Bounded size, mergeable sketch of a stream of values from which
+    approximate percentiles can be read (the KLL sketch of Karnin, Lang &
+    Liberty 2016).  Values are kept in a hierarchy of compactors: whenever a
+    compactor fills, it is sorted and every other item is promoted to the
+    next level with twice the weight.  Memory is O(k) regardless of stream
+    length, and results are exact until roughly k values have been seen.
+
+    Error bound: the rank of each returned percentile is within eps * n of
+    the requested rank with high probability, where n is the number of values
+    added and eps is roughly 2.3 / k^0.97 (about 1.3% for the default k=200,
+    at 99% confidence).  Merging sketches built over disjoint parts of a
+    stream gives the same guarantee as a single sketch over the whole stream.
+    """
+    def __init__(self, k=200):
+        """
+        Create a new sketch.
+        @param k accuracy parameter controlling the sketch size.
+        """
+        self.k = k
+        self.n = 0
+        self.size = 0
+        self.compactors = [list()]
+        self.max_size = self.capacity(0)
+
+    def capacity(self, level):
+        """
+        Maximum number of items that may be held at the given compactor level.
+        @param level 0-based compactor level (0 holds unit weight items)
+        @return int item capacity
+        """
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def grow(self):
+        """
+        Add a new (highest weight) compactor level.
+        """
+        self.compactors.append(list())
+        self.max_size = sum(self.capacity(x) for x in
+                            xrange(len(self.compactors)))
+
+    def add(self, val):
+        """
+        Add a new value to the sketch.
+        @param val the value to add
+        """
+        self.compactors[0].append(val)
+        self.n += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def merge(self, other):
+        """
+        Fold the contents of another sketch into this one.
+        @param other QuantileSketch instance.  It is left unchanged.
+        """
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.n += other.n
+        self.size += other.size
+        self.compress()
+
+    def compress(self):
+        """
+        Compact full levels until the sketch is back under its size limit.
+        """
+        while self.size >= self.max_size:
+            for level in xrange(len(self.compactors)):
+                items = self.compactors[level]
+                if len(items) >= self.capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.grow()
+                    items.sort()
+                    # keep back the largest item of an odd length list
+                    leftover = items[-1:] if len(items) % 2 else []
+                    offset = random.randint(0, 1)
+                    promoted = items[offset:len(items) - len(leftover):2]
+                    self.compactors[level + 1].extend(promoted)
+                    self.compactors[level] = leftover
+                    self.size -= len(items) - len(leftover) - len(promoted)
+                    break
+
+    def weighted_items(self):
+        """
+        Return the items currently held, in sorted order, each paired with
+        the number of stream values it stands in for.
+        @return list of (value, weight) tuples
+        """
+        res = list()
+        for level, items in enumerate(self.compactors):
+            res.extend((x, 1 << level) for x in items)
+        res.sort()
+        return res
+
+    def get_percentiles(self, percentiles=[50], only_numeric=False):
+        """
+        Determine and return the (approximate) specified percentiles, using
+        the same ordering and index conventions as StatList.get_percentiles.
+        @param percentiles list of numeric values [1-99]
+        @param only_numeric if True leading missing values are skipped
+        @return list of values corresponding to the percentiles.
+        """
+        items = self.weighted_items()
+        start = 0
+        skipped = 0
+        if only_numeric:
+            while start < len(items) and items[start][0] in [None, '']:
+                skipped += items[start][1]
+                start += 1
+            if start == len(items):
+                start = 0
+                skipped = 0
+        num_recs = self.n - skipped
+        res = list()
+        for x in percentiles:
+            rank = int(float(x) / 100 * num_recs)
+            seen = 0
+            val = None
+            for item, weight in items[start:]:
+                val = item
+                seen += weight
+                if seen > rank:
+                    break
+            res.append(val)
+        return res
+
+
+class StreamStatList:
+    """
+    Bounded memory alternative to StatList.  Count, min, max and mean are
+    kept as running scalars, while the mode and percentiles are approximated
+    by fixed size sketches, so memory does not grow with the number of
+    records added.  The mode is only estimated if track_mode is set.
+    """
+    ## number of distinct values tracked when estimating the mode
+    mode_size = 64
+    ## accuracy parameter of the percentile sketch
+    sketch_size = 200
+    ## estimate the mode?
+    track_mode = True
+
+    @classmethod
+    def estimate_bytes(cls, keysets, values):
+        """
+        Roughly estimate the memory taken by a stats dictionary of these
+        lists, as measured on 64 bit CPython 2.7: about 2.6KB for each keyset
+        plus 180 bytes for each value added, until its sketches are full at
+        about 110 bytes per unit of sketch_size (24KB for the default).
+        @param keysets number of keysets in the dictionary
+        @param values total number of values added to its lists
+        @return estimated size in bytes
+        """
+        return 2600 * keysets + min(180 * values,
+                                    110 * cls.sketch_size * keysets)
+
+    def __init__(self):
+        self.count = 0
+        self.num_count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.modes = ModeSketch(self.mode_size) if self.track_mode else None
+        self.quantiles = QuantileSketch(self.sketch_size)
+
+    def add(self, keyed_rec):
+        """
+        Add a new KeyedRecord to this stats list.
+        @param keyed_rec a KeyedRecord instance.  Only its value is retained.
+        """
+        val = keyed_rec.val
+        self.count += 1
+        if isinstance(val, (int, float)):
+            self.num_count += 1
+            self.total += val
+            if val < self.min:
+                self.min = val
+            if val > self.max:
+                self.max = val
+        if self.modes is not None:
+            self.modes.add(val)
+        self.quantiles.add(val)
+
+    def merge(self, other):
+        """
+        Fold the statistics of another StreamStatList into this one.
+        @param other StreamStatList instance.  It is left unchanged.
+        """
+        self.count += other.count
+        self.num_count += other.num_count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self.modes is None or other.modes is None:
+            self.modes = None
+        else:
+            self.modes.merge(other.modes)
+        self.quantiles.merge(other.quantiles)
+
+    def to_bytes(self):
+        """
+        Serialize this list to a compact binary string: the zlib compressed
+        JSON encoding of a list of its fields, led by STATS_FORMAT.  Only
+        plain values are written, so decoding never runs code or depends on
+        the names of classes and their attributes.  The numbers and strings
+        of each sketch are written apart (their order within it doesn't
+        matter), so that numbers need no conversion when read back and
+        strings, read as Latin-1, keep all their bytes.
+        @return string encoding
+        """
+        modes = None
+        if self.modes is not None:
+            modes = [self.modes.size,
+                     split_strs(self.modes.counts.iteritems(), itemgetter(0))]
+        q = self.quantiles
+        return zlib.compress(json.dumps(
+            [STATS_FORMAT, self.count, self.num_count, self.total, self.min,
+             self.max, modes, q.k, q.n, [split_strs(x) for x in q.compactors]],
+            encoding='latin-1', separators=(',', ':')))
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        Reconstruct a StreamStatList from the output of to_bytes.
+        @param data string encoding
+        @return StreamStatList instance
+        @throws StatsFormatError if data is not in the current format
+        """
+        try:
+            fields = json.loads(zlib.decompress(data))
+            if fields[0] != STATS_FORMAT:
+                raise StatsFormatError("version %s, expected %d" %
+                                       (fields[0], STATS_FORMAT))
+            version, count, num_count, total, min_val, max_val, modes, k, n, \
+                compactors = fields
+            res = StreamStatList()
+            res.count = count
+            res.num_count = num_count
+            res.total = total
+            res.min = min_val
+            res.max = max_val
+            res.modes = None
+            if modes is not None:
+                res.modes = ModeSketch(modes[0])
+                res.modes.counts = dict(modes[1][0])
+                res.modes.counts.update((x.encode('latin-1'), y) for x, y in
+                                        modes[1][1])
+            q = QuantileSketch(k)
+            q.compactors = [x + [y.encode('latin-1') for y in z] for x, z in
+                            compactors]
+            q.max_size = sum(q.capacity(x) for x in xrange(len(compactors)))
+            q.n = n
+            q.size = sum(len(x) for x in q.compactors)
+            res.quantiles = q
+        except (zlib.error, ValueError, TypeError, IndexError, AttributeError):
+            raise StatsFormatError("not a serialized StreamStatList")
+        return res
+
+    def dumps(self):
+        """
+        Serialize this list to a single line of text (no delimiters or
+        newlines), suitable for storing alongside a stats table.
+        @return string encoding
+        """
+        return base64.b64encode(self.to_bytes())
+
+    @staticmethod
+    def loads(data):
+        """
+        Reconstruct a StreamStatList from the output of dumps.
+        @param data string encoding
+        @return StreamStatList instance
+        """
+        return StreamStatList.from_bytes(base64.b64decode(data))
+
+    def get_count(self):
+        """
+        Return the number of items added to this list.
+        @return int specifying the item count
+        """
+        return self.count
+
+    def get_min(self):
+        """
+        Return the minimum numeric value added to this list.
+        @return float specifying the min value.
+        """
+        return self.min if self.num_count > 0 else float('nan')
+
+    def get_max(self):
+        """
+        Return the maximum numeric value added to this list.
+        @return float specifying the max value.
+        """
+        return self.max if self.num_count > 0 else float('nan')
+
+    def get_mean(self):
+        """
+        Return the average of the numeric values added to this list.
+        @return float specifying average value.
+        """
+        if self.num_count > 0:
+            return self.total / self.num_count
+        return float('nan')
+
+    def get_mode(self):
+        """
+        Estimate the most frequently occuring value in this list.
+        @return most frequent value and count as a tuple.  The value is None
+                if the mode isn't being tracked
+        """
+        if self.modes is None:
+            return (None, 0)
+        return self.modes.get_mode()
+
+    def get_percentiles(self, percentiles=[50], only_numeric=False):
+        """
+        Estimate and return the specified percentiles.
+        @param percentiles list of numeric values [1-99] specifying
+               percentile(s) to compute.  Defaults to median i.e. [50]
+        @param only_numeric if True missing values are skipped
+        @return list of values corresponding to the percentiles.
+        """
+        return self.quantiles.get_percentiles(percentiles, only_numeric)
+
+
+class ClockCache:
+    """
+    Mapping holding at most size items, evicting roughly the least recently
+    used item once full (the CLOCK algorithm).  A hit is a single dictionary
+    lookup plus setting the item's reference bit, rather than reordering the
+    items as an exact LRU would.  Counts of lookup hits and misses are kept.
+    """
+    def __init__(self, size):
+        """
+        Create a new cache.
+        @param size maximum number of items to hold
+        """
+        self.size = size
+        self.items = dict()
+        self.ring = list()
+        self.hand = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Look up a cached item, marking it as recently used.
+        @param key the item key
+        @return the cached item or None if not present
+        """
+        entry = self.items.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        entry[1] = True
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, val):
+        """
+        Add an item to the cache, first evicting an item not used since the
+        clock hand last passed it if the cache is full.
+        @param key the item key
+        @param val the item to store
+        """
+        if key in self.items:
+            self.items[key][0] = val
+            return
+        if len(self.ring) < self.size:
+            self.ring.append(key)
+        else:
+            ring = self.ring
+            items = self.items
+            while items[ring[self.hand]][1]:
+                items[ring[self.hand]][1] = False
+                self.hand = (self.hand + 1) % self.size
+            del items[ring[self.hand]]
+            ring[self.hand] = key
+            self.hand = (self.hand + 1) % self.size
+        self.items[key] = [val, False]
+
+
+class KeyedRecord(object):
     """
     A single line of a KeyedFile containing indexing field and value values.
     """
+    __slots__ = ('keys', 'val', 'dates')
+
     def __init__(self, keys, value, dates):
         """
         Create a new record.
@@ -201,14 +963,359 @@ class KeyedRecord:
                                                              self.dates)
 
 
+def read_byte_range(fname, start, end):
+    """
+    Yield the lines of a file that start at a byte offset within
+    [start, end).  Adjacent ranges therefore partition the file's lines
+    without splitting any of them.
+    @param fname name of the (uncompressed) file to read
+    @param start offset of the first byte of the range
+    @param end offset just past the last byte of the range
+    @return generator of lines
+    """
+    with open(fname) as f:
+        pos = start
+        if start > 0:
+            # skip the remainder of a line begun in the previous range
+            f.seek(start - 1)
+            pos += len(f.readline()) - 1
+        while pos < end:
+            ln = f.readline()
+            if not ln:
+                break
+            pos += len(ln)
+            yield ln
+
+
+def split_inputs(fnames, parts=1):
+    """
+    Divide the input files into roughly equal sized jobs for parallel
+    ingestion.  Uncompressed files are split into byte ranges, while stdin
+    and compressed files can only be read whole.
+    @param fnames list of input file names
+    @param parts number of jobs to aim for
+    @return list of (fname, byte_range) tuples.  byte_range is None when the
+            whole file is to be read.
+    """
+    res = list()
+    per_file = max(1, parts // max(1, len(fnames)))
+    for fname in fnames:
+        if (per_file == 1 or fname == "-" or
+                os.path.splitext(fname)[1] in (".gz", ".bz2")):
+            res.append((fname, None))
+            continue
+        size = os.path.getsize(fname)
+        step = max(1, int(math.ceil(float(size) / per_file)))
+        res.extend((fname, (x, min(x + step, size))) for x in
+                   xrange(0, size, step))
+    return res
+
+
+def merge_stat_dicts(dst, src):
+    """
+    Fold the per-keyset statistics of src into dst.  Since the merge of each
+    stats list is associative, partial results may be combined in any order.
+    @param dst dictionary mapping keysets to StatList (or StreamStatList)
+           instances.  Updated in place.
+    @param src dictionary of the same type as dst.
+    @return dst
+    """
+    for k, s in src.iteritems():
+        if k in dst:
+            dst[k].merge(s)
+        else:
+            dst[k] = s
+    return dst
+
+
+def stat_list_class(args):
+    """
+    Select the type of stats list to collect values in.
+    @param args parsed command line arguments
+    @return StatList class or subclass thereof
+    """
+    if args.stream:
+        return StreamStatList
+    elif args.numpy:
+        return NumpyStatList
+    return StatList
+
+
+def ingest(job):
+    """
+    Build the per-keyset statistics for an input file, or part of one.
+    @param job 3-tuple containing the file name, byte range (or None) and
+           args
+    @return 2-tuple containing a dictionary mapping keyset tuples to stats
+            lists, and a list of the names of any run files the stats were
+            spilled to (see spill_stats) after exceeding args.budget MB
+    """
+    fname, byte_range, args = job
+    stat_list = stat_list_class(args)
+    d = defaultdict(stat_list)
+    runs = list()
+    recnum = 0
+    values = 0
+    budget = args.budget * (1 << 20)
+    kf = KeyedFile(fname, args.field, args.key, args.backoff, args.delim,
+                   args.header, args.date, args.lag, args.width, args.alpha,
+                   byte_range, args.keysetcache)
+    keysets = kf.source_keysets if args.state is not None else kf.all_keysets
+    dirty = set() if args.snapshotfile is not None else None
+    for kr in kf.read_recs():
+        recnum += 1
+        kss = keysets(kr)
+        for ks in kss:
+            d[ks].add(kr)
+        if dirty is not None:
+            dirty.update(kss)
+        values += len(kss)
+        if budget > 0 and stat_list.estimate_bytes(len(d), values) > budget:
+            runs.append(spill_stats(d))
+            d.clear()
+            values = 0
+        if args.printevery > 0 and recnum % args.printevery == 0:
+            if dirty is not None:
+                write_snapshot(d, dirty, args, "%s\trange=%s\trec=%d" %
+                               (fname, byte_range, recnum))
+                dirty.clear()
+            sys.stderr.write("rec: %s\tunique_keys: %s\tdate_hits: %.1f%%"
+                             % (locale.format("%d", recnum, grouping=True),
+                                locale.format("%d", len(d), grouping=True),
+                                100 * kf.date_hit_rate()))
+            if kf.keyset_cache is not None:
+                sys.stderr.write("\tkeyset_hits: %s\tkeyset_misses: %s" % (
+                                 locale.format("%d", kf.keyset_cache.hits,
+                                               grouping=True),
+                                 locale.format("%d", kf.keyset_cache.misses,
+                                               grouping=True)))
+            sys.stderr.write("\r")
+    return (d, runs)
+
+
+def write_snapshot(d, keys, args, label):
+    """
+    Append the current stats rows of the given keysets to args.snapshotfile,
+    preceded by a marker line.  Only the keysets passed are computed, and
+    with StreamStatLists (which main requires) each in bounded time, so the
+    cost depends on how many changed rather than on the records read.
+    d must hold all of the stats read so far (i.e. none were spilled to
+    disk or are held by other workers), which main ensures by refusing -O
+    together with -B, -C or -S.
+    @param d dictionary mapping keyset tuples to stats lists
+    @param keys collection of keysets whose rows are to be written
+    @param args parsed command line arguments
+    @param label text identifying the snapshot, added to its marker line
+    """
+    rows = [calc_stats((d[k], k, args)) for k in sorted(keys)]
+    out = "#snapshot\t%s\tkeys=%d\n" % (label, len(rows))
+    out += "".join(x + "\n" for x in rows)
+    with open(args.snapshotfile, 'a') as f:
+        f.write(out)
+
+
+def spill_stats(d):
+    """
+    Write the contents of a stats dictionary to a temporary run file, in
+    sorted key order.
+    @param d dictionary mapping keyset tuples to stats lists
+    @return name of the run file created
+    """
+    fd, fname = tempfile.mkstemp(prefix="keyed_stats_", suffix=".run")
+    with os.fdopen(fd, 'wb') as f:
+        for k in sorted(d.iterkeys()):
+            cPickle.dump((k, d[k]), f, 2)
+    return fname
+
+
+def read_run(fname, run_idx):
+    """
+    Yield the contents of a run file written by spill_stats.
+    @param fname name of the run file
+    @param run_idx number identifying this run, included in the results so
+           that entries with equal keys never compare their stats lists
+    @return generator of (keyset, run_idx, stats list) tuples in key order
+    """
+    with open(fname, 'rb') as f:
+        while True:
+            try:
+                k, s = cPickle.load(f)
+            except EOFError:
+                break
+            yield (k, run_idx, s)
+
+
+def iter_merged_stats(d, runs):
+    """
+    K-way merge the spilled run files and the stats still held in memory,
+    combining the stats of keysets that appear in more than one of them.
+    The run files are deleted once consumed.
+    @param d dictionary mapping keyset tuples to stats lists
+    @param runs list of run file names
+    @return generator of (keyset, stats list) tuples in sorted key order
+    """
+    sources = [read_run(x, idx) for idx, x in enumerate(runs)]
+    sources.append((k, len(runs), d[k]) for k in sorted(d.iterkeys()))
+    try:
+        for k, grp in groupby(heapq.merge(*sources), itemgetter(0)):
+            s = next(grp)[2]
+            for item in grp:
+                s.merge(item[2])
+            yield (k, s)
+    finally:
+        for x in runs:
+            os.remove(x)
+
+
+def month_window(dt, month_lag=0, month_prior_group=0):
+    """
+    Compute and return all valid months for a given datetime, based on
+    number of prior months to compute and any lag.
+    @param dt datetime object specifying year and month
+    @param month_lag number of months of lag (see KeyedFile)
+    @param month_prior_group number of prior months grouped (see KeyedFile)
+    @return list of YYYYMM strings, preceded by '' for all months
+    """
+    # lag date needs to be added, so an original date of 2013-08 with a 2
+    # month lag, would be calculated towards the count for 2013-10
+    lagdt = dt + relativedelta(months=month_lag)
+    return [''] + [(dt + relativedelta(months=x)).strftime('%Y%m') for
+                   x in xrange(0, -month_prior_group - 1, -1)]
+
+
+def state_meta(args):
+    """
+    Describe the settings that saved state depends upon, so that a state
+    file is only ever updated with compatible records.
+    @param args parsed command line arguments
+    @return dictionary of settings
+    """
+    meta = dict(version=2, field=args.field, key=list(args.key),
+                backoff=list(args.backoff), date=list(args.date),
+                alpha=args.alpha, stats=stat_list_class(args).__name__,
+                sketchsize=args.sketchsize)
+    if args.stream:
+        meta['mode'] = args.mode
+    return meta
+
+
+def load_state(fname, args):
+    """
+    Read the per source keyset stats saved by save_state.
+    @param fname name of the state file
+    @param args parsed command line arguments, which must match those the
+           state was built with.
+    @return dictionary mapping source keysets to stats lists
+    @throws StateMismatchError if the state was built with other settings
+    @throws StatsFormatError if the saved stats can't be decoded
+    """
+    num_dates = len(args.date)
+    stat_list = stat_list_class(args)
+    res = dict()
+    with open(fname, 'rb') as f:
+        try:
+            meta = json.loads(f.readline())
+        except ValueError:
+            raise StateMismatchError("%s is not a state file" % fname)
+        if meta != json.loads(json.dumps(state_meta(args),
+                                         encoding='latin-1')):
+            raise StateMismatchError("%s built with %s" % (fname, meta))
+        while True:
+            sizes = f.read(12)
+            if len(sizes) == 0:
+                break
+            try:
+                key_size, size = struct.unpack('<IQ', sizes)
+                key = [latin1_bytes(x) for x in json.loads(f.read(key_size))]
+            except (struct.error, ValueError, TypeError):
+                raise StatsFormatError("%s: truncated keyset" % fname)
+            dates = tuple(datetime.datetime.strptime(x, '%Y%m') for x in
+                          key[len(key) - num_dates:])
+            res[tuple(key[:len(key) - num_dates]) + dates] = \
+                stat_list.from_bytes(f.read(size))
+    return res
+
+
+def save_state(fname, d, args):
+    """
+    Save per source keyset stats (see KeyedFile.source_keysets) so that they
+    can later be updated with newer records instead of being rebuilt.  The
+    file holds a line of JSON describing the settings (see state_meta)
+    followed by each keyset in turn: a 4 and an 8 byte little-endian size,
+    the keyset as a JSON list (dates as YYYYMM) and its serialized stats.
+    @param fname name of the state file to (over)write
+    @param d dictionary mapping source keysets to stats lists
+    @param args parsed command line arguments
+    """
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, 'wb') as f:
+        f.write(json.dumps(state_meta(args), encoding='latin-1') + "\n")
+        for k, s in d.iteritems():
+            key = json.dumps(key_strs(k), encoding='latin-1')
+            data = s.to_bytes()
+            f.write(struct.pack('<IQ', len(key), len(data)) + key + data)
+    os.rename(tmp_fname, fname)
+
+
+def age_state(d, num_dates, retain):
+    """
+    Drop the stats of source months that have fallen out of the retention
+    window, measured back from the latest month present.
+    @param d dictionary mapping source keysets to stats lists.  Updated in
+           place.
+    @param num_dates number of date fields at the end of each keyset
+    @param retain number of months to retain.  0 retains everything.
+    @return the earliest month retained as a YYYYMM string, or None if
+            nothing was dropped
+    """
+    if retain <= 0 or num_dates == 0 or len(d) == 0:
+        return None
+    latest = max(max(k[-num_dates:]) for k in d)
+    cutoff = latest - relativedelta(months=retain - 1)
+    for k in [x for x in d if min(x[-num_dates:]) < cutoff]:
+        del d[k]
+    return cutoff.strftime('%Y%m')
+
+
+def expand_state(d, args, first=None):
+    """
+    Expand per source keyset stats into the per keyset stats of a table,
+    by folding each into every month window its dates belong to.
+    @param d dictionary mapping source keysets to stats lists
+    @param args parsed command line arguments
+    @param first if given, the earliest source month retained (see
+           age_state).  Months before it are left out of the table, as
+           some of the source months of their windows were dropped.
+    @return dictionary mapping keyset tuples to stats lists
+    """
+    res = defaultdict(stat_list_class(args))
+    num_dates = len(args.date)
+    windows = dict()
+    for k, s in d.iteritems():
+        keys = k[:len(k) - num_dates]
+        datelists = list()
+        for dt in k[len(k) - num_dates:]:
+            if dt not in windows:
+                windows[dt] = [x for x in month_window(dt, args.lag,
+                                                       args.width)
+                               if first is None or x == '' or x >= first]
+            datelists.append(windows[dt])
+        for dates in product(*datelists):
+            res[keys + dates].merge(s)
+    return res
+
+
 class KeyedFile:
     """
     Input file containing key indexing fields and a value field to compute
     statistics over.
     """
+    ## number of leading values used to infer the value field type
+    type_sample = 1000
+
     def __init__(self, fname, stat_field, keys, backoffs, delim="\t",
                  header=False, dates=None, month_lag=0, month_prior_group=0,
-                 alpha_order=False):
+                 alpha_order=False, byte_range=None, keyset_cache_size=0):
         """
         Create a new instance.
         @param fname name of the file containing fields to process.  Use '-'
@@ -240,16 +1347,33 @@ class KeyedFile:
                value for 201309 will include all record values from 201303 -
                201309 inclusive.  Defaults to 0 for no prior months included.
         @param alpha_order boolean indicating whether stat_field values should
-               be ordered numerically (False), or alphabetically (True).
+               be ordered numerically (False), or alphabetically (True).  In
+               the latter case values are never converted to numbers.
                Defaults to False.
+        @param byte_range optional (start, end) tuple of byte offsets into an
+               uncompressed fname.  If given only the lines starting within
+               this range are read (see split_inputs).  Defaults to None for
+               the entire file.
+        @param keyset_cache_size if positive, remember the expanded keysets
+               of up to this many of the most recently seen key and date value
+               combinations.  Defaults to 0 for no caching.
         """
-        self.f = fileinput.FileInput(fname,
-                                     openhook=fileinput.hook_compressed)
         self.delim = delim
         if fname == "-" and os.isatty(0):
             raise EmptyStdinError("stdin empty")
+        if byte_range is None:
+            self.f = fileinput.FileInput(fname,
+                                         openhook=fileinput.hook_compressed)
+            hdr_ln = self.f.readline() if header else None
+        else:
+            with open(fname) as f:
+                hdr_ln = f.readline() if header else None
+            start = byte_range[0]
+            if hdr_ln is not None:
+                start = max(start, len(hdr_ln))
+            self.f = read_byte_range(fname, start, byte_range[1])
         if header:
-            names = self.f.readline().rstrip('\n').rstrip('\r').split(delim)
+            names = hdr_ln.rstrip('\n').rstrip('\r').split(delim)
         else:
             names = []
         self.field = self.names_to_cols(names, stat_field)[0]
@@ -259,6 +1383,13 @@ class KeyedFile:
         self.month_lag = month_lag
         self.month_group = month_prior_group
         self.alpha_order = alpha_order
+        self.date_cache = dict()
+        self.month_cache = dict()
+        self.date_hits = 0
+        self.date_misses = 0
+        self.keyset_cache = None
+        if keyset_cache_size > 0:
+            self.keyset_cache = ClockCache(keyset_cache_size)
         if len(self.keys) == 0 and len(self.dates) == 0:
             raise FieldNotFoundError("0 keys specified")
 
@@ -314,20 +1445,61 @@ class KeyedFile:
     def read_recs(self):
         """
         Extract the relevant key and value fields from each record in this
-        file (yielded one at a time)
+        file (yielded one at a time).  Values are converted to float unless
+        alpha_order is set.  The first type_sample values decide whether the
+        field is treated as numeric, after which values of a non-numeric field
+        are only converted when they could possibly be a number.
         @return generator of KeyedRecord objects
         """
+        numeric = None
+        sampled = 0
+        failed = 0
         for ln in self.f:
             ln = ln.rstrip('\n').rstrip('\r').split(self.delim)
             val = ln[self.field - 1]
-            try:
-                val = float(val)
-            except ValueError:
+            if self.alpha_order:
                 pass
+            elif numeric is None:
+                sampled += 1
+                try:
+                    val = float(val)
+                except ValueError:
+                    failed += 1
+                if sampled == self.type_sample:
+                    numeric = 2 * failed <= sampled
+            elif numeric or val[:1] in FLOAT_CHARS:
+                try:
+                    val = float(val)
+                except ValueError:
+                    pass
             yield KeyedRecord(tuple(ln[x - 1] for x in self.keys), val,
-                              tuple(datetime.datetime.strptime(ln[x - 1
-                                    ].replace('-', '').replace(' ', ''),
-                                    "%Y%m") for x in self.dates))
+                              tuple(self.parse_date(ln[x - 1]) for x in
+                                    self.dates))
+
+    def parse_date(self, raw):
+        """
+        Convert a date field value to a datetime.  Results are cached by the
+        raw string, since date fields typically hold few distinct values.
+        @param raw the date field value
+        @return datetime object
+        """
+        try:
+            dt = self.date_cache[raw]
+            self.date_hits += 1
+        except KeyError:
+            dt = datetime.datetime.strptime(raw.replace('-', '').replace(' ',
+                                            ''), "%Y%m")
+            self.date_cache[raw] = dt
+            self.date_misses += 1
+        return dt
+
+    def date_hit_rate(self):
+        """
+        Return the fraction of date field values served from the cache.
+        @return float in [0, 1]
+        """
+        total = self.date_hits + self.date_misses
+        return float(self.date_hits) / total if total > 0 else 0.0
 
     def valid_months(self, dt):
         """
@@ -336,11 +1508,7 @@ class KeyedFile:
         @param dt datetime object specifying year and month
         @return list of datetime objects
         """
-        # lag date needs to be added, so an original date of 2013-08 with a 2
-        # month lag, would be calculated towards the count for 2013-10
-        lagdt = dt + relativedelta(months=self.month_lag)
-        return [''] + [(dt + relativedelta(months=x)).strftime('%Y%m') for
-                       x in xrange(0, -self.month_group - 1, -1)]
+        return month_window(dt, self.month_lag, self.month_group)
 
     def all_keysets(self, kr):
         """
@@ -351,6 +1519,39 @@ class KeyedFile:
                permutations
         @return list of key value tuples
         """
+        if self.keyset_cache is not None:
+            res = self.keyset_cache.get((kr.keys, kr.dates))
+            if res is None:
+                res = self.expand_keysets(kr)
+                self.keyset_cache.put((kr.keys, kr.dates), res)
+            return res
+        return self.expand_keysets(kr)
+
+    def expand_keysets(self, kr):
+        """
+        Compute the key permutations of a KeyedRecord (see all_keysets),
+        bypassing any cache.
+        @param kr the KeyedRecord to expand
+        @return tuple of key value tuples
+        """
+        keylists = self.key_lists(kr)
+        datelists = list()
+        for dt in kr.dates:
+            try:
+                datelists.append(self.month_cache[dt])
+            except KeyError:
+                self.month_cache[dt] = self.valid_months(dt)
+                datelists.append(self.month_cache[dt])
+        keylists.extend(datelists)
+        return tuple(product(*keylists))
+
+    def key_lists(self, kr):
+        """
+        Compute the candidate values of each (non-date) key of a KeyedRecord:
+        the value itself, blank, and any backoff values.
+        @param kr the KeyedRecord to expand
+        @return list of lists of key values
+        """
         keylists = []
         for idx in xrange(len(kr.keys)):
             k = kr.keys[idx]
@@ -360,9 +1561,67 @@ class KeyedFile:
             if k in self.backoffs[idx]:
                 val.extend(self.backoffs[idx][k])
             keylists.append(val)
-        datelists = [self.valid_months(x) for x in kr.dates]
-        keylists.extend(datelists)
-        return tuple(product(*keylists))
+        return keylists
+
+    def source_keysets(self, kr):
+        """
+        Compute the permutations of the (non-date) keys of a KeyedRecord,
+        each followed by the record's own dates rather than their month
+        windows.  Stats collected under these keysets can later be expanded
+        to all_keysets form via expand_state, which is what allows saved
+        state to be updated with newer records.
+        @param kr the KeyedRecord to expand
+        @return tuple of key value tuples
+        """
+        return tuple(x + kr.dates for x in product(*self.key_lists(kr)))
+
+
+def key_strs(k):
+    """
+    Convert a keyset tuple to the list of strings written to output tables.
+    @param k tuple of key values
+    @return list of strings
+    """
+    return [x.strftime('%Y%m') if isinstance(x, datetime.datetime) else
+            str(x) for x in k]
+
+
+def write_sketches(fname, d, delim="\t"):
+    """
+    Write the serialized StreamStatList of each keyset to a file, one line
+    per keyset in the same (sorted) order as the stats table.  merge_tables
+    uses a file named after the table plus SKETCH_SUFFIX when one exists.
+    @param fname name of the file to create
+    @param d dictionary mapping keyset tuples to StreamStatList instances
+    @param delim field separator
+    """
+    with open(fname, 'w') as f:
+        for k in sorted(d.iterkeys()):
+            f.write(delim.join(key_strs(k)) + delim + d[k].dumps() + "\n")
+
+
+def read_sketches(fnames, delim="\t"):
+    """
+    Load and merge the sketch files written alongside each of the tables
+    given.
+    @param fnames list of table filenames
+    @param delim field separator
+    @return dictionary mapping key string tuples to merged StreamStatList
+            instances, or None if any table lacks a sketch file.
+    """
+    sketch_fnames = [x + SKETCH_SUFFIX for x in fnames]
+    if not all(os.path.exists(x) for x in sketch_fnames):
+        return None
+    res = dict()
+    for ln in fileinput.FileInput(sketch_fnames):
+        rec = ln.rstrip('\n').rstrip('\r').split(delim)
+        key = tuple(rec[:-1])
+        s = StreamStatList.loads(rec[-1])
+        if key in res:
+            res[key].merge(s)
+        else:
+            res[key] = s
+    return res
 
 
 def calc_stats(data_args):
@@ -374,8 +1633,7 @@ def calc_stats(data_args):
     s = data_args[0]
     k = data_args[1]
     args = data_args[2]
-    out = args.delim.join([x.strftime('%Y%m') if isinstance(x,
-                           datetime.datetime) else str(x) for x in k])
+    out = args.delim.join(key_strs(k))
     if args.count:
         out += args.delim + str(s.get_count())
     if args.min:
@@ -393,6 +1651,105 @@ def calc_stats(data_args):
     return out
 
 
+def calc_stats_range(bounds):
+    """
+    Calculate the stats rows for a contiguous range of the keysets held in
+    _shared.  Workers forked after _shared has been populated inherit it, so
+    only the range bounds and resulting text cross process boundaries.
+    @param bounds 2-tuple of start and end indices into the sorted keysets
+    @return string containing the newline terminated rows for the range
+    """
+    d = _shared['stats']
+    args = _shared['args']
+    return "".join(calc_stats((d[k], k, args)) + "\n" for k in
+                   _shared['keys'][bounds[0]:bounds[1]])
+
+
+def write_stats(d, args, out=sys.stdout, writer=None):
+    """
+    Calculate and write the stats row of each keyset to out, in sorted key
+    order, a range of at most STATS_RANGE keysets at a time.  With
+    args.cores > 1 the ranges are farmed out to worker processes, and their
+    results streamed back in order.
+    @param d dictionary mapping keyset tuples to stats lists
+    @param args parsed command line arguments
+    @param out file object to write the rows to.  Defaults to stdout
+    @param writer optional BinaryTableWriter also given each row
+    """
+    _shared['stats'] = d
+    _shared['keys'] = sorted(d.iterkeys())
+    _shared['args'] = args
+    num_keys = len(_shared['keys'])
+    step = STATS_RANGE
+    if args.cores > 1:
+        step = max(1, min(step, num_keys // (args.cores * 16)))
+    bounds = ((x, x + step) for x in xrange(0, num_keys, step))
+    if args.cores > 1:
+        pool = Pool(processes=args.cores)
+        chunks = pool.imap(calc_stats_range, bounds)
+    else:
+        chunks = imap(calc_stats_range, bounds)
+    for idx, chunk in enumerate(chunks):
+        out.write(chunk)
+        if writer is not None:
+            keys = _shared['keys'][idx * step:(idx + 1) * step]
+            for k, row in zip(keys, chunk.split("\n")):
+                writer.add_row(row, d[k] if args.stream else None)
+    if args.cores > 1:
+        pool.close()
+    _shared.clear()
+
+
+def write_merged_stats(d, runs, args, out=sys.stdout, writer=None):
+    """
+    Calculate and write the stats row of each keyset to out, in sorted key
+    order, merging the in-memory stats with those spilled to run files.
+    @param d dictionary mapping keyset tuples to stats lists
+    @param runs list of run file names written by spill_stats
+    @param args parsed command line arguments
+    @param out file object to write the rows to.  Defaults to stdout
+    @param writer optional BinaryTableWriter also given each row
+    """
+    sketch_f = None
+    if args.sketchfile is not None:
+        sketch_f = open(args.sketchfile, 'w')
+    for k, s in iter_merged_stats(d, runs):
+        row = calc_stats((s, k, args))
+        out.write(row + "\n")
+        if writer is not None:
+            writer.add_row(row, s if args.stream else None)
+        if sketch_f is not None:
+            sketch_f.write(args.delim.join(key_strs(k)) + args.delim +
+                           s.dumps() + "\n")
+    if sketch_f is not None:
+        sketch_f.close()
+
+
+def stats_header(args):
+    """
+    Construct the header line of the stats table described by args.
+    @param args parsed command line arguments
+    @return string containing the delimited field names
+    """
+    res = args.delim.join(args.key)
+    if len(args.date) > 0:
+        res += args.delim + args.delim.join(args.date)
+    if args.count:
+        res += args.delim + args.field + "_count"
+    if args.min:
+        res += args.delim + args.field + "_min"
+    if args.max:
+        res += args.delim + args.field + "_max"
+    if args.mean:
+        res += args.delim + args.field + "_mean"
+    if args.mode:
+        res += args.delim + args.field + "_mode"
+    if len(args.percentile) > 0:
+        res += args.delim + args.delim.join([args.field + "_percentile_" +
+                                             str(x) for x in args.percentile])
+    return res
+
+
 def prep_arg_parser():
     """
     Define any command line arguments passed to the script.
@@ -414,7 +1771,8 @@ def prep_arg_parser():
     p.add_argument("-f", "--field",
                    help="calculate stats on the field name/offset given")
     p.add_argument("-a", "--alpha", default=False, action='store_true',
-                   help="order field values alphabetically instead of numeric")
+                   help="order field values alphabetically instead of "
+                        "numerically, without converting them to numbers")
     p.add_argument("-p", "--percentile", action="append",
                    default=["1", "5", "25", "50", "75", "95", "99"],
                    help="add a new percentile value to field stats")
@@ -437,36 +1795,558 @@ def prep_arg_parser():
     p.add_argument("-w", "--width", type=int, default=0,
                    help="include date values from this many prior months")
     p.add_argument("-P", "--printevery", type=int, default=0,
-                   help="dump stats every printeveryth line. disable via 0")
+                   help="%s%s" % ("dump progress (and -O stats) every ",
+                                  "printeveryth line. disable via 0"))
+    p.add_argument("-s", "--stream", action='store_true', default=False,
+                   help="%s%s" % ("use bounded memory running stats (mode ",
+                                  "and percentiles become approximate)"))
+    p.add_argument("-N", "--numpy", action='store_true', default=False,
+                   help="calculate stats with NumPy (faster on large keys)")
+    p.add_argument("-K", "--sketchsize", type=int, default=200,
+                   help="accuracy/size of the --stream percentile sketch")
+    p.add_argument("-Z", "--sketchfile",
+                   help="%s%s" % ("also write --stream sketches to this file ",
+                                  "(name it TABLE.sketch for -R to use it)"))
+    p.add_argument("-L", "--keysetcache", type=int, default=0,
+                   help="cache expanded keysets of this many recent keys")
+    p.add_argument("-B", "--budget", type=float, default=0,
+                   help="%s%s" % ("spill stats to disk once they take more ",
+                                  "than about this many MB of memory. not "
+                                  "with -S. disable via 0"))
+    p.add_argument("-S", "--state",
+                   help="save per source month stats to STATE for --update")
+    p.add_argument("-u", "--update", action='store_true', default=False,
+                   help="fold INFILE records into those saved in --state")
+    p.add_argument("-r", "--retain", type=int, default=0,
+                   help="%s%s%s" % ("keep this many latest months in ",
+                                    "--state, and only table months whose ",
+                                    "window they cover. keep all via 0"))
+    p.add_argument("-O", "--snapshotfile",
+                   help="%s%s" % ("append stats of keysets changed since the ",
+                                  "last -P dump to this file. requires -s, "
+                                  "not with -B, -C or -S"))
+    p.add_argument("-b", "--binaryfile",
+                   help="%s%s" % ("also write the table (and any -s ",
+                                  "sketches) in binary form for fast -R"))
     p.add_argument("-C", "--cores", type=int, default=1,
-                   help="calculate stats in parallel using many CPU cores")
+                   help="read and calculate stats in parallel on many cores")
     p.add_argument("-R", "--merge", action='append', default=list(),
                    help="list of tables to merge instead of create")
-    p.add_argument("infile", metavar="INFILE", nargs='?', default="-",
-                   help="construct tables from INFILE (instead of stdin)")
+    p.add_argument("--sorted", action='store_true', default=False,
+                   help="%s%s" % ("-R tables are sorted by key (as written ",
+                                  "here): stream merge them using -C cores"))
+    p.add_argument("infile", metavar="INFILE", nargs='*', default=["-"],
+                   help="%s%s" % ("construct tables from INFILE(s) (instead ",
+                                  "of stdin).  Read in parallel when -C > 1"))
     return p
 
 
-def merge_tables(fnames, delim="\t", printevery=0):
+def pad8(size):
+    """
+    Round a byte count up to a multiple of 8.
+    @param size number of bytes
+    @return int
+    """
+    return (size + 7) // 8 * 8
+
+
+def is_binary_table(fname):
+    """
+    Determine whether a file holds a table written by BinaryTableWriter.
+    @param fname name of the file.  '-' (stdin) is always a text table, and
+           is not read
+    @return boolean
+    """
+    if fname == "-":
+        return False
+    with open(fname, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+class BinaryTableWriter:
+    """
+    Writes a stats table in a compact binary columnar format which
+    BinaryTable can read through mmap without parsing any text.  The file
+    holds BINARY_MAGIC, a 4 byte little-endian header length and a JSON
+    header describing the table (its strings hold the bytes of the table
+    header read as Latin-1, so that any encoding survives), followed by
+    each column in turn (8 byte aligned):
+     - 'q' columns hold one int64 per row
+     - 'd' columns hold one float64 per row
+     - 's' columns hold rows + 1 offsets (uint32, or uint64 if the column
+       holds 4GB or more) followed by the concatenated bytes of the values
+       (serialized StreamStatLists for the sketch column)
+    Column types follow the stat kind: the count column is 'q' and, unless
+    the field is ordered alphabetically, the other stat columns are 'd'.
+    A numeric column falls back to 's' should any of its values not read
+    back as exactly the same text, so stats are never rewritten (e.g. "0501"
+    as "501.0").  Key columns are always 's'.
+    """
+    def __init__(self, fname, hdr, delim="\t", sketches=False, alpha=False):
+        """
+        Create a new writer.  Rows are spooled to temporary files until
+        close() is called.
+        @param fname name of the file to create
+        @param hdr the header line of the table
+        @param delim field separator of hdr and of the rows added
+        @param sketches if True a StreamStatList must be supplied with each
+               row, to be stored alongside it
+        @param alpha if True the stats other than the count hold field values
+               ordered alphabetically (see KeyedFile), and are stored as text
+        """
+        self.fname = fname
+        self.hdr = hdr
+        self.delim = delim
+        self.names = hdr.split(delim)
+        self.rows = 0
+        self.spools = [tempfile.TemporaryFile() for x in self.names]
+        self.sizes = [0] * len(self.names)
+        layout = TableLayout(hdr, delim)
+        count_idx = None
+        if layout.count_idx is not None:
+            count_idx = layout.val_idcs[layout.count_idx]
+        self.ints = [x == count_idx for x in xrange(len(self.names))]
+        self.floats = [not alpha and x in layout.val_idcs and x != count_idx
+                       for x in xrange(len(self.names))]
+        self.sketch_spool = tempfile.TemporaryFile() if sketches else None
+        self.sketch_size = 0
+
+    def add_row(self, row, sketch=None):
+        """
+        Append a row to the table.
+        @param row the delimited table row (without line terminator)
+        @param sketch StreamStatList for the row, if the table has sketches
+        """
+        for idx, val in enumerate(row.split(self.delim)):
+            self.spools[idx].write(val + "\n")
+            self.sizes[idx] += len(val)
+            if self.ints[idx]:
+                try:
+                    self.ints[idx] = str(int(val)) == val
+                except ValueError:
+                    self.ints[idx] = False
+            elif self.floats[idx]:
+                try:
+                    self.floats[idx] = str(float(val)) == val
+                except ValueError:
+                    self.floats[idx] = False
+        if self.sketch_spool is not None:
+            data = sketch.to_bytes()
+            self.sketch_spool.write(struct.pack('<I', len(data)) + data)
+            self.sketch_size += len(data)
+        self.rows += 1
+
+    def close(self):
+        """
+        Write out the table file and discard the spooled rows.
+        """
+        columns = list()
+        offset = 0
+        for idx, name in enumerate(self.names):
+            col_type = 'q' if self.ints[idx] else ('d' if self.floats[idx]
+                                                   else 's')
+            columns.append(dict(name=name, type=col_type, offset=offset))
+            if col_type == 's':
+                columns[-1]['width'] = 4 if self.sizes[idx] < 1 << 32 else 8
+                offset += pad8(columns[-1]['width'] * (self.rows + 1) +
+                               self.sizes[idx])
+            else:
+                offset += 8 * self.rows
+        sketch = None
+        if self.sketch_spool is not None:
+            sketch = dict(name="sketch", type='s', offset=offset,
+                          width=4 if self.sketch_size < 1 << 32 else 8)
+        meta = json.dumps(dict(hdr=self.hdr, delim=self.delim, rows=self.rows,
+                               columns=columns, sketch=sketch),
+                          encoding='latin-1')
+        meta += " " * (pad8(8 + len(meta)) - 8 - len(meta))
+        with open(self.fname, 'wb') as f:
+            f.write(BINARY_MAGIC + struct.pack('<I', len(meta)) + meta)
+            for col, spool in zip(columns, self.spools):
+                if col['type'] == 's':
+                    self.write_strings(f, col['width'],
+                                       lambda: self.read_spool(spool))
+                else:
+                    conv = int if col['type'] == 'q' else float
+                    self.write_array(f, col['type'], (conv(x) for x in
+                                                      self.read_spool(spool)))
+                spool.close()
+            if self.sketch_spool is not None:
+                self.write_strings(f, sketch['width'], self.read_sketches)
+                self.sketch_spool.close()
+
+    def read_spool(self, spool):
+        """
+        Yield the values spooled for a column so far.
+        @param spool the column's spool file
+        @return generator of strings
+        """
+        spool.seek(0)
+        for ln in spool:
+            yield ln[:-1]
+
+    def read_sketches(self):
+        """
+        Yield the serialized sketches spooled so far.
+        @return generator of strings
+        """
+        self.sketch_spool.seek(0)
+        for x in xrange(self.rows):
+            size = struct.unpack('<I', self.sketch_spool.read(4))[0]
+            yield self.sketch_spool.read(size)
+
+    def write_array(self, f, typecode, vals):
+        """
+        Write numeric values to f as little-endian 8 byte items.
+        @param f file object to write to
+        @param typecode struct format character: 'q', 'Q' or 'd'
+        @param vals iterable of the values
+        """
+        buf = list()
+        for val in vals:
+            buf.append(val)
+            if len(buf) == 65536:
+                f.write(struct.pack('<%d%s' % (len(buf), typecode), *buf))
+                buf = list()
+        f.write(struct.pack('<%d%s' % (len(buf), typecode), *buf))
+
+    def write_strings(self, f, width, read_vals):
+        """
+        Write string values to f as an offset array followed by the
+        concatenated values, padded to a multiple of 8 bytes.
+        @param f file object to write to
+        @param width size of each offset in bytes: 4 or 8
+        @param read_vals function returning an iterable of the values.  It is
+               called twice.
+        """
+        offsets = [0]
+        for val in read_vals():
+            offsets.append(offsets[-1] + len(val))
+        self.write_array(f, 'I' if width == 4 else 'Q', offsets)
+        for val in read_vals():
+            f.write(val)
+        size = width * len(offsets) + offsets[-1]
+        f.write("\0" * (pad8(size) - size))
+
+
+class BinaryTable:
+    """
+    Read-only view of a table written by BinaryTableWriter.  The file is
+    memory mapped and values are decoded in place as they are requested.
+    """
+    def __init__(self, fname):
+        """
+        Open a binary table.
+        @param fname name of the file
+        """
+        self.f = open(fname, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_len = struct.unpack_from('<I', self.mm, len(BINARY_MAGIC))[0]
+        start = len(BINARY_MAGIC) + 4
+        meta = json.loads(self.mm[start:start + meta_len])
+        base = start + meta_len
+        self.hdr = meta['hdr'].encode('latin-1')
+        self.rows = meta['rows']
+        self.columns = [(str(x['type']), base + x['offset'], x.get('width'))
+                        for x in meta['columns']]
+        self.sketch = None
+        if meta['sketch'] is not None:
+            self.sketch = ('s', base + meta['sketch']['offset'],
+                           meta['sketch']['width'])
+
+    def read(self, column, row):
+        """
+        Decode a single value.
+        @param column (type, offset, offset width) tuple describing the
+               column
+        @param row 0-based row number
+        @return int, float or string value.  Missing floats (NaN) are
+                returned as the string "nan", as they appear in text tables
+        """
+        col_type, offset, width = column
+        if col_type == 'q':
+            return struct.unpack_from('<q', self.mm, offset + 8 * row)[0]
+        elif col_type == 'd':
+            val = struct.unpack_from('<d', self.mm, offset + 8 * row)[0]
+            return "nan" if val != val else val
+        start, end = struct.unpack_from('<2I' if width == 4 else '<2Q',
+                                        self.mm, offset + width * row)
+        base = offset + width * (self.rows + 1)
+        return self.mm[base + start:base + end]
+
+    def read_rows(self, column, start, count):
+        """
+        Decode the values of a column in a range of rows at once.  Numeric
+        values are unpacked in a single call and returned as numbers.
+        @param column (type, offset, offset width) tuple describing the
+               column
+        @param start 0-based number of the first row
+        @param count number of rows
+        @return list of values, as returned by read
+        """
+        col_type, offset, width = column
+        if col_type == 'q':
+            return list(struct.unpack_from('<%dq' % count, self.mm,
+                                           offset + 8 * start))
+        elif col_type == 'd':
+            return [x if x == x else "nan" for x in
+                    struct.unpack_from('<%dd' % count, self.mm,
+                                       offset + 8 * start)]
+        ends = struct.unpack_from(('<%dI' if width == 4 else '<%dQ') %
+                                  (count + 1), self.mm, offset + width * start)
+        base = offset + width * (self.rows + 1)
+        mm = self.mm
+        return [mm[base + ends[x]:base + ends[x + 1]] for x in xrange(count)]
+
+    def value(self, idx, row):
+        """
+        Decode the value of a column in a row.
+        @param idx 0-based column index, as in the table header
+        @param row 0-based row number
+        @return the value
+        """
+        return self.read(self.columns[idx], row)
+
+    def get_sketch(self, row):
+        """
+        Decode the StreamStatList stored with a row.
+        @param row 0-based row number
+        @return StreamStatList instance, or None if the table has no sketches
+        """
+        if self.sketch is None:
+            return None
+        return StreamStatList.from_bytes(self.read(self.sketch, row))
+
+    def close(self):
+        """
+        Release the memory map and file.
+        """
+        self.mm.close()
+        self.f.close()
+
+
+def iter_binary_table(fname, src_idx, layout, sketches=False):
+    """
+    Yield the rows of a binary table one at a time (see iter_table).  Rows
+    are decoded a block at a time, column by column.  Numeric stat values
+    are passed on as numbers (merge_table_rows accepts either), and stat
+    values are not decoded at all when sketches are used, as they are
+    recomputed from the sketches anyway.
+    @param fname name of the table file
+    @param src_idx number identifying this table
+    @param layout TableLayout of the table
+    @param sketches if True also decode the sketch of each row
+    @return generator of (key, src_idx, stat values, sketch) tuples
+    @throws TableOrderError if the table is not sorted
+    """
+    t = BinaryTable(fname)
+    key_cols = [t.columns[x] for x in layout.key_idcs]
+    val_cols = [t.columns[x] for x in layout.val_idcs]
+    prev = None
+    for start in xrange(0, t.rows, BINARY_BLOCK):
+        count = min(BINARY_BLOCK, t.rows - start)
+        keys = zip(*[t.read_rows(x, start, count) for x in key_cols])
+        if sketches:
+            rows = [None] * count
+        else:
+            rows = zip(*[t.read_rows(x, start, count) for x in val_cols])
+        for idx in xrange(count):
+            key = keys[idx]
+            if prev is not None and key < prev:
+                raise TableOrderError("%s: %s follows %s" %
+                                      (fname, key, prev))
+            prev = key
+            sketch = t.get_sketch(start + idx) if sketches else None
+            yield (key, src_idx, rows[idx], sketch)
+    t.close()
+
+
+def table_has_sketches(fname):
+    """
+    Determine whether sketches are available for a table.
+    @param fname name of the table file
+    @return boolean
+    """
+    if is_binary_table(fname):
+        t = BinaryTable(fname)
+        res = t.sketch is not None
+        t.close()
+        return res
+    return os.path.exists(fname + SKETCH_SUFFIX)
+
+
+class TableLayout:
+    """
+    Roles of the columns of a stats table, as determined from its header.
+    """
+    def __init__(self, hdr, delim="\t"):
+        """
+        Create a new layout.
+        @param hdr the header line of the table (without line terminator)
+        @param delim field separator in the table
+        """
+        self.hdr = hdr
+        self.key_idcs = list()
+        self.val_idcs = list()
+        self.count_idx = None
+        self.min_idx = None
+        self.max_idx = None
+        self.mean_idx = None
+        self.mode_idx = None
+        self.percentile_idcs = list()
+        self.percentiles = list()
+        for idx, val in enumerate(hdr.split(delim)):
+            if val.endswith("_count"):
+                self.count_idx = len(self.val_idcs)
+                self.val_idcs.append(idx)
+            elif val.endswith("_min"):
+                self.min_idx = len(self.val_idcs)
+                self.val_idcs.append(idx)
+            elif val.endswith("_max"):
+                self.max_idx = len(self.val_idcs)
+                self.val_idcs.append(idx)
+            elif val.endswith("_mean"):
+                self.mean_idx = len(self.val_idcs)
+                self.val_idcs.append(idx)
+            elif val.endswith("_mode"):
+                self.mode_idx = len(self.val_idcs)
+                self.val_idcs.append(idx)
+            elif val.find("_percentile_") >= 0:
+                self.percentiles.append(val.split("_percentile_")[-1])
+                self.percentile_idcs.append(len(self.val_idcs))
+                self.val_idcs.append(idx)
+            else:
+                self.key_idcs.append(idx)
+
+    def split(self, rec):
+        """
+        Extract the key and stat values of a table row.
+        @param rec list of field values of the row
+        @return 2-tuple of the key value tuple and stat value tuple
+        """
+        return (tuple(rec[x] for x in self.key_idcs),
+                tuple(rec[x] for x in self.val_idcs))
+
+
+def merge_table_rows(key, rows, layout, delim="\t", sketch=None,
+                     numpercentile=False):
+    """
+    Combine the rows of several tables sharing the same key into one.
+    @param key tuple of key values
+    @param rows list of stat value tuples, as returned by TableLayout.split
+    @param layout TableLayout of the tables
+    @param delim field separator
+    @param sketch merged StreamStatList of the key, if available, from which
+           the stats are recomputed instead of approximated from rows.
+    @param numpercentile if True missing values are skipped when computing
+           percentiles from sketch.
+    @return the merged table row as a string
+    """
+    rec = delim.join(key)
+    if sketch is not None:
+        s = sketch
+        vals = [""] * len(layout.val_idcs)
+        if layout.count_idx is not None:
+            vals[layout.count_idx] = s.get_count()
+        if layout.min_idx is not None:
+            vals[layout.min_idx] = s.get_min()
+        if layout.max_idx is not None:
+            vals[layout.max_idx] = s.get_max()
+        if layout.mean_idx is not None:
+            vals[layout.mean_idx] = s.get_mean()
+        if layout.mode_idx is not None:
+            vals[layout.mode_idx] = s.get_mode()[0]
+        for idx, val in zip(layout.percentile_idcs,
+                            s.get_percentiles(layout.percentiles,
+                                              numpercentile)):
+            vals[idx] = val
+        return delim.join((rec, delim.join(str(x) for x in vals)))
+    if len(rows) == 1:
+        return delim.join((rec, delim.join(str(x) for x in rows[0])))
+    count_idx = layout.count_idx
+    min_idx = layout.min_idx
+    max_idx = layout.max_idx
+    mean_idx = layout.mean_idx
+    mode_idx = layout.mode_idx
+    vals = [""] * len(layout.val_idcs)
+    items = zip(*rows)
+    if count_idx is not None:
+        vals[count_idx] = sum([int(x) for x in items[count_idx]])
+    if min_idx is not None:
+        try:
+            vals[min_idx] = min([float(x) for x in items[min_idx]
+                                 if x not in ("", "nan")])
+        except ValueError:
+            vals[min_idx] = ""
+    if max_idx is not None:
+        try:
+            vals[max_idx] = max([float(x) for x in items[max_idx]
+                                 if x not in ("", "nan")])
+        except ValueError:
+            vals[max_idx] = ""
+    if mean_idx is not None:
+        if count_idx is not None:
+            weights = (float(x) / vals[count_idx] for x in
+                       items[count_idx])
+        else:
+            weights = ([1. / len(items[mean_idx])] *
+                       len(items[mean_idx]))
+        try:
+            vals[mean_idx] = sum(x[0] * float(x[1]) for x in
+                                 zip(weights, items[mean_idx])
+                                 if x[1] not in ("", "nan"))
+            if vals[mean_idx] == 0:
+                vals[mean_idx] = ""
+        except ValueError:
+            vals[mean_idx] = ""
+    if mode_idx is not None:
+        c = defaultdict(int)
+        for i in xrange(len(items[mode_idx])):
+            if count_idx is not None:
+                this_count = int(items[count_idx][i])
+            else:
+                this_count = 1
+            # binary tables pass numbers, tally them as text tables would
+            c[str(items[mode_idx][i])] += this_count
+        v = list(c.values())
+        k = list(c.keys())
+        vals[mode_idx] = k[v.index(max(v))]
+    if len(layout.percentile_idcs) > 0:
+        # in lieu of a better approx. take ~median of each percentile
+        # TODO: weight by count
+        for idx in layout.percentile_idcs:
+            num_vals = [float(x) for x in items[idx] if x not in
+                        ("", "nan")]
+            if len(num_vals) > 0:
+                vals[idx] = sorted(num_vals)[len(num_vals) / 2]
+            else:
+                vals[idx] = ""
+    return delim.join((rec, delim.join(str(x) for x in vals)))
+
+
+def merge_tables(fnames, delim="\t", printevery=0, numpercentile=False,
+                 sketchfile=None, binaryfile=None):
     """
     Merges the list of already built tables and dumps the results to standard
-    output.
+    output.  If every table has a sketch file alongside it (see
+    write_sketches), the statistics are recomputed exactly (percentiles
+    within the sketch error bound) from the merged sketches, otherwise they
+    are approximated from the table values.
     @param fnames a list of filenames containing already created tables of the
            same type
     @param delim field sepearator in the tables
     @param printevery if set to a positive integer the current record count is
            written to std.err
+    @param numpercentile if True missing values are skipped when computing
+           percentiles from sketches.
+    @param sketchfile if specified (and sketches are available) the merged
+           sketches are also written to this file.
+    @param binaryfile if specified the merged table is also written to this
+           file in binary form (see BinaryTableWriter).
     """
+    sketches = read_sketches(fnames, delim)
     d = defaultdict(list)
-    hdr = None
-    key_idcs = list()
-    val_idcs = list()
-    count_idx = None
-    min_idx = None
-    max_idx = None
-    mean_idx = None
-    mode_idx = None
-    percentile_idcs = list()
+    layout = None
     f = fileinput.FileInput(fnames, openhook=fileinput.hook_compressed)
     for ln in f:
         if printevery > 0 and f.lineno() % printevery == 0:
@@ -477,99 +2357,199 @@ def merge_tables(fnames, delim="\t", printevery=0):
         rec = ln.rstrip('\n').rstrip('\r').split(delim)
         if f.isfirstline():
             # header line, process if not done so already
-            if hdr is None:
-                hdr = ln.rstrip('\n').rstrip('\r')
-                for idx, val in enumerate(rec):
-                    if val.endswith("_count"):
-                        count_idx = len(val_idcs)
-                        val_idcs.append(idx)
-                    elif val.endswith("_min"):
-                        min_idx = len(val_idcs)
-                        val_idcs.append(idx)
-                    elif val.endswith("_max"):
-                        max_idx = len(val_idcs)
-                        val_idcs.append(idx)
-                    elif val.endswith("_mean"):
-                        mean_idx = len(val_idcs)
-                        val_idcs.append(idx)
-                    elif val.endswith("_mode"):
-                        mode_idx = len(val_idcs)
-                        val_idcs.append(idx)
-                    elif val.find("_percentile_") >= 0:
-                        percentile_idcs.append(len(val_idcs))
-                        val_idcs.append(idx)
-                    else:
-                        key_idcs.append(idx)
+            if layout is None:
+                layout = TableLayout(ln.rstrip('\n').rstrip('\r'), delim)
             else:
                 if printevery > 0:
                     sys.stderr.write('\n')
         else:
             # append to current dictionary
-            d[tuple(rec[x] for x in key_idcs)].append(tuple(rec[x] for x in
-                                                            val_idcs))
+            key, vals = layout.split(rec)
+            d[key].append(vals)
     if printevery > 0:
         sys.stderr.write('\n')
     # now write out the in-memory structure, merging results
-    print(hdr)
+    print(layout.hdr)
+    writer = None
+    if binaryfile is not None:
+        writer = BinaryTableWriter(binaryfile, layout.hdr, delim,
+                                   sketches is not None)
     for key in sorted(d.keys()):
-        rec = delim.join(key)
-        if len(d[key]) == 1:
-            rec = delim.join((rec, delim.join(d[key][0])))
-        else:
-            vals = [""] * len(val_idcs)
-            items = zip(*d[key])
-            if count_idx is not None:
-                vals[count_idx] = sum([int(x) for x in items[count_idx]])
-            if min_idx is not None:
-                try:
-                    vals[min_idx] = min([float(x) for x in items[min_idx]
-                                         if x not in ("", "nan")])
-                except ValueError:
-                    vals[min_idx] = ""
-            if max_idx is not None:
-                try:
-                    vals[max_idx] = max([float(x) for x in items[max_idx]
-                                         if x not in ("", "nan")])
-                except ValueError:
-                    vals[max_idx] = ""
-            if mean_idx is not None:
-                if count_idx is not None:
-                    weights = (float(x) / vals[count_idx] for x in
-                               items[count_idx])
-                else:
-                    weights = ([1. / len(items[mean_idx])] *
-                               len(items[mean_idx]))
-                try:
-                    vals[mean_idx] = sum(x[0] * float(x[1]) for x in
-                                         zip(weights, items[mean_idx])
-                                         if x[1] not in ("", "nan"))
-                    if vals[mean_idx] == 0:
-                        vals[mean_idx] = ""
-                except ValueError:
-                    vals[mean_idx] = ""
-            if mode_idx is not None:
-                c = defaultdict(int)
-                for i in xrange(len(items[mode_idx])):
-                    if count_idx is not None:
-                        this_count = int(items[count_idx][i])
-                    else:
-                        this_count = 1
-                    c[items[mode_idx][i]] += this_count
-                v = list(c.values())
-                k = list(c.keys())
-                vals[mode_idx] = k[v.index(max(v))]
-            if len(percentile_idcs) > 0:
-                # in lieu of a better approx. take ~median of each percentile
-                # TODO: weight by count
-                for idx in percentile_idcs:
-                    num_vals = [float(x) for x in items[idx] if x not in 
-                                ("", "nan")]
-                    if len(num_vals) > 0:
-                        vals[idx] = sorted(num_vals)[len(num_vals) / 2]
-                    else:
-                        vals[idx] = ""
-            rec = delim.join((rec, delim.join(str(x) for x in vals)))
-        print(rec)
+        sketch = sketches.get(key) if sketches is not None else None
+        row = merge_table_rows(key, d[key], layout, delim, sketch,
+                               numpercentile)
+        print(row)
+        if writer is not None:
+            writer.add_row(row, sketch)
+    if writer is not None:
+        writer.close()
+    if sketches is not None and sketchfile is not None:
+        write_sketches(sketchfile, sketches, delim)
+
+
+def iter_table(fname, src_idx, layout, delim="\t", sketches=False, f=None):
+    """
+    Yield the rows of a key sorted stats table one at a time, checking that
+    they really are in sorted order.
+    @param fname name of the table file
+    @param src_idx number identifying this table, included in the results so
+           that rows with equal keys from different tables never compare
+           their remaining fields
+    @param layout TableLayout of the table
+    @param delim field separator
+    @param sketches if True also read the sketch of each row from the
+           table's sketch file
+    @param f if given, the table already opened with its header read (as
+           stdin can only be opened once)
+    @return generator of (key, src_idx, stat values, sketch) tuples.  sketch
+            is None unless sketches is True.
+    @throws TableOrderError if the table (or its sketch file) is not sorted
+    """
+    if f is None:
+        f = fileinput.FileInput(fname, openhook=fileinput.hook_compressed)
+        f.readline()
+    sf = open(fname + SKETCH_SUFFIX) if sketches else None
+    prev = None
+    for ln in f:
+        key, vals = layout.split(ln.rstrip('\n').rstrip('\r').split(delim))
+        if prev is not None and key < prev:
+            raise TableOrderError("%s: %s follows %s" % (fname, key, prev))
+        prev = key
+        sketch = None
+        if sf is not None:
+            rec = sf.readline().rstrip('\n').rstrip('\r').split(delim)
+            if tuple(rec[:-1]) != key:
+                raise TableOrderError("%s%s: %s does not match table key %s" %
+                                      (fname, SKETCH_SUFFIX, rec[:-1], key))
+            sketch = StreamStatList.loads(rec[-1])
+        yield (key, src_idx, vals, sketch)
+    f.close()
+    if sf is not None:
+        sf.close()
+
+
+def merge_sorted_tables(fnames, delim="\t", printevery=0, numpercentile=False,
+                        sketchfile=None, out=sys.stdout, binaryfile=None):
+    """
+    Merges a list of already built, key sorted tables (as written by this
+    script), streaming through them all at once so that only the current
+    row of each needs to be held in memory.  Tables may be text or binary
+    (see BinaryTableWriter).  Sketches are used as in merge_tables when
+    every table has them.
+    @param fnames a list of filenames containing already created tables of the
+           same type
+    @param delim field sepearator in the tables
+    @param printevery if set to a positive integer the current merged key
+           count is written to std.err
+    @param numpercentile if True missing values are skipped when computing
+           percentiles from sketches.
+    @param sketchfile if specified (and sketches are available) the merged
+           sketches are also written to this file.
+    @param out file object to write the merged table to.  Defaults to
+           stdout.  Pass None to skip writing text output.
+    @param binaryfile if specified the merged table is also written to this
+           file in binary form.
+    @throws TableOrderError if any table is not sorted
+    """
+    first = None
+    if is_binary_table(fnames[0]):
+        t = BinaryTable(fnames[0])
+        layout = TableLayout(t.hdr, delim)
+        t.close()
+    else:
+        # left open for iter_table to read on from
+        first = fileinput.FileInput(fnames[0],
+                                    openhook=fileinput.hook_compressed)
+        layout = TableLayout(first.readline().rstrip('\n').rstrip('\r'),
+                             delim)
+    sketches = all(table_has_sketches(x) for x in fnames)
+    sketch_f = None
+    if sketches and sketchfile is not None:
+        sketch_f = open(sketchfile, 'w')
+    writer = None
+    if binaryfile is not None:
+        writer = BinaryTableWriter(binaryfile, layout.hdr, delim, sketches)
+    if out is not None:
+        out.write(layout.hdr + "\n")
+    sources = [iter_binary_table(x, idx, layout, sketches) if
+               is_binary_table(x) else
+               iter_table(x, idx, layout, delim, sketches,
+                          first if idx == 0 else None) for idx, x in
+               enumerate(fnames)]
+    num_keys = 0
+    for key, grp in groupby(heapq.merge(*sources), itemgetter(0)):
+        items = list(grp)
+        sketch = items[0][3]
+        for item in items[1:]:
+            if sketch is not None:
+                sketch.merge(item[3])
+        row = merge_table_rows(key, [x[2] for x in items], layout, delim,
+                               sketch, numpercentile)
+        if out is not None:
+            out.write(row + "\n")
+        if writer is not None:
+            writer.add_row(row, sketch)
+        if sketch_f is not None:
+            sketch_f.write(delim.join(key) + delim + sketch.dumps() + "\n")
+        num_keys += 1
+        if printevery > 0 and num_keys % printevery == 0:
+            sys.stderr.write("merged keys: %s\r" % locale.format(
+                             "%d", num_keys, grouping=True))
+    if printevery > 0:
+        sys.stderr.write('\n')
+    if sketch_f is not None:
+        sketch_f.close()
+    if writer is not None:
+        writer.close()
+
+
+def merge_table_group(job):
+    """
+    Merge a group of sorted tables into a temporary binary table (including
+    sketches if available), as one branch of a parallel merge tree.
+    @param job 3-tuple containing the list of table names, the field
+           separator and the numpercentile flag
+    @return name of the merged temporary table
+    """
+    fnames, delim, numpercentile = job
+    fd, fname = tempfile.mkstemp(prefix="keyed_stats_", suffix=".ksb")
+    os.close(fd)
+    merge_sorted_tables(fnames, delim, 0, numpercentile, None, None, fname)
+    return fname
+
+
+def merge_sorted_tables_parallel(fnames, delim="\t", printevery=0,
+                                 numpercentile=False, sketchfile=None,
+                                 cores=1, binaryfile=None):
+    """
+    Merges a list of key sorted tables using a two level merge tree: groups
+    of tables are first merged in parallel to temporary tables, which are
+    then merged to standard output.  See merge_sorted_tables.  This is only
+    done if every table has sketches, since merging the mode and percentiles
+    of tables without them is approximate and not associative: the tree
+    would give different results from a single merge.
+    @param cores number of groups of tables to merge in parallel
+    """
+    if (cores > 1 and len(fnames) > cores and
+            not all(table_has_sketches(x) for x in fnames)):
+        sys.stderr.write("warning: not all tables have sketches, merging "
+                         "them on a single core\n")
+        cores = 1
+    if cores <= 1 or len(fnames) <= cores:
+        merge_sorted_tables(fnames, delim, printevery, numpercentile,
+                            sketchfile, binaryfile=binaryfile)
+        return
+    pool = Pool(processes=cores)
+    groups = [(fnames[x::cores], delim, numpercentile) for x in
+              xrange(cores)]
+    tmp_fnames = pool.map(merge_table_group, groups)
+    pool.close()
+    try:
+        merge_sorted_tables(tmp_fnames, delim, printevery, numpercentile,
+                            sketchfile, binaryfile=binaryfile)
+    finally:
+        for x in tmp_fnames:
+            os.remove(x)
 
 
 def main():
@@ -578,51 +2558,98 @@ def main():
     args = parser.parse_args()
     if len(args.merge) == 0 and args.field is None:
         parser.error("at least one of -f or -R is required")
+    if (args.sketchfile is not None and not args.stream and
+            len(args.merge) == 0):
+        parser.error("-Z requires -s")
+    if args.snapshotfile is not None and args.printevery <= 0:
+        parser.error("-O requires -P")
+    if args.snapshotfile is not None and not args.stream:
+        # a StatList is sorted in full to compute its row, and the all keys
+        # rows change with every record
+        parser.error("-O requires -s")
+    if args.snapshotfile is not None and (args.budget > 0 or args.cores > 1
+                                          or args.state is not None):
+        # snapshots would only hold the partial stats of a spill run, a
+        # worker or a source month
+        parser.error("-O can't be combined with -B, -C or -S")
+    if args.update and args.state is None:
+        parser.error("-u requires -S")
+    if args.budget > 0 and args.state is not None:
+        # saving and expanding state needs all of its stats in memory
+        parser.error("-B can't be combined with -S")
+    if args.numpy and np is None:
+        parser.error("-N requires the numpy package")
     if len(args.merge) > 0:
         # merge mode instead
-        merge_tables(args.merge, args.delim, args.printevery)
+        try:
+            if args.sorted or any(is_binary_table(x) for x in args.merge):
+                merge_sorted_tables_parallel(args.merge, args.delim,
+                                             args.printevery,
+                                             args.numpercentile,
+                                             args.sketchfile, args.cores,
+                                             args.binaryfile)
+            else:
+                merge_tables(args.merge, args.delim, args.printevery,
+                             args.numpercentile, args.sketchfile,
+                             args.binaryfile)
+        except TableOrderError as e:
+            sys.stderr.write("error: unsorted table: %s\n" % str(e))
+            sys.exit(4)
+        except StatsFormatError as e:
+            sys.stderr.write("error: unreadable sketches: %s\n" % str(e))
+            sys.exit(5)
         sys.exit(0)
-    d = defaultdict(StatList)
-    recnum = 0
+    StreamStatList.sketch_size = args.sketchsize
+    StreamStatList.track_mode = args.mode
     args.backoff = [x.split(',')[1] if ',' in x else None for x in args.key
                     if x.split(',')[0] not in args.date]
     args.key = [x.split(',')[0] for x in args.key
                 if x.split(',')[0] not in args.date]
     try:
-        kf = KeyedFile(args.infile, args.field, args.key, args.backoff,
-                       args.delim, args.header, args.date, args.lag,
-                       args.width, args.alpha)
-        for kr in kf.read_recs():
-            recnum += 1
-            for ks in kf.all_keysets(kr):
-                d[ks].add(kr)
-            if args.printevery > 0 and recnum % args.printevery == 0:
-                sys.stderr.write("rec: %s\tunique_keys: %s\r" % (
-                                 locale.format("%d", recnum, grouping=True),
-                                 locale.format("%d", len(d), grouping=True)))
+        if args.snapshotfile is not None:
+            with open(args.snapshotfile, 'w') as f:
+                f.write(stats_header(args) + "\n")
+        jobs = [x + (args,) for x in split_inputs(args.infile, args.cores)]
+        if args.cores > 1 and len(jobs) > 1:
+            pool = Pool(processes=args.cores)
+            parts = pool.imap_unordered(ingest, jobs)
+        else:
+            parts = (ingest(x) for x in jobs)
+        stat_list = stat_list_class(args)
+        d = defaultdict(stat_list)
+        runs = list()
+        budget = args.budget * (1 << 20)
+        for part, part_runs in parts:
+            merge_stat_dicts(d, part)
+            runs.extend(part_runs)
+            if budget > 0:
+                values = sum(x.get_count() for x in d.itervalues())
+                if stat_list.estimate_bytes(len(d), values) > budget:
+                    runs.append(spill_stats(d))
+                    d.clear()
+        if args.cores > 1 and len(jobs) > 1:
+            pool.close()
+        if args.state is not None:
+            if args.update and os.path.exists(args.state):
+                d = merge_stat_dicts(load_state(args.state, args), d)
+            first = age_state(d, len(args.date), args.retain)
+            save_state(args.state, d, args)
+            d = expand_state(d, args, first)
         sys.stderr.write('\n')
-        out_hdr = args.delim.join(args.key)
-        if len(args.date) > 0:
-            out_hdr += args.delim + args.delim.join(args.date)
-        if args.count:
-            out_hdr += args.delim + args.field + "_count"
-        if args.min:
-            out_hdr += args.delim + args.field + "_min"
-        if args.max:
-            out_hdr += args.delim + args.field + "_max"
-        if args.mean:
-            out_hdr += args.delim + args.field + "_mean"
-        if args.mode:
-            out_hdr += args.delim + args.field + "_mode"
-        if len(args.percentile) > 0:
-            out_hdr += args.delim + args.delim.join([args.field +
-                                                     "_percentile_" + str(x)
-                                                     for x in
-                                                     args.percentile])
-        print out_hdr
-        pool = Pool(processes=args.cores)
-        print "\n".join(pool.map(calc_stats, [(d[k], k, args) for k in
-                        sorted(d.iterkeys())]))
+        print stats_header(args)
+        sys.stdout.flush()
+        writer = None
+        if args.binaryfile is not None:
+            writer = BinaryTableWriter(args.binaryfile, stats_header(args),
+                                       args.delim, args.stream, args.alpha)
+        if len(runs) > 0:
+            write_merged_stats(d, runs, args, writer=writer)
+        else:
+            write_stats(d, args, writer=writer)
+            if args.sketchfile is not None:
+                write_sketches(args.sketchfile, d, args.delim)
+        if writer is not None:
+            writer.close()
     except EmptyStdinError:
         print("warning: no files specified and nothing waiting at stdin")
         parser.print_help()
@@ -631,6 +2658,12 @@ def main():
         print("warning: invalid field name/offset specified: " + str(f))
         parser.print_help()
         sys.exit(2)
+    except StateMismatchError as e:
+        print("warning: incompatible state file: " + str(e))
+        sys.exit(3)
+    except StatsFormatError as e:
+        print("warning: unreadable state file: " + str(e))
+        sys.exit(3)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+""" @namespace test_keyed_join
+Check that each keyed_join mode writes the same merged records as the default
+in-memory join.
+"""
+
+import sys
+import os
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+## the script under test
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "keyed_join.py")
+
+
+def write_table(fname, hdr, rows, delim="\t"):
+    """
+    Write a header and records to a file.
+    @param fname name of the file to write
+    @param hdr list of field names
+    @param rows iterable of lists of field values
+    @param delim the field separator
+    """
+    with open(fname, "w") as f:
+        f.write(delim.join(hdr) + "\n")
+        for row in rows:
+            f.write(delim.join([str(x) for x in row]) + "\n")
+
+
+def sort_table(fname, out_name, key_idcs, delim="\t"):
+    """
+    Write a copy of a file with its records sorted by join key values, as by
+    `LC_ALL=C sort -s`.
+    @param fname name of the file to copy
+    @param out_name name of the sorted copy
+    @param key_idcs 0-based offsets of the join key fields
+    @param delim the field separator
+    """
+    with open(fname) as f:
+        hdr = f.readline()
+        lines = f.readlines()
+    lines.sort(key=lambda x: [x.rstrip("\n").split(delim)[y] for y in
+                              key_idcs])
+    with open(out_name, "w") as f:
+        f.write(hdr)
+        f.writelines(lines)
+
+
+def run_join(args, stdin_name):
+    """
+    Run keyed_join.py with the first file read from stdin.
+    @param args list of command line arguments
+    @param stdin_name name of the first file
+    @return 2-tuple containing the exit status and the output written
+    """
+    with open(stdin_name) as f:
+        p = subprocess.Popen([sys.executable, SCRIPT] + args, stdin=f,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+    return (p.returncode, out)
+
+
+class KeyedJoinModeTest(unittest.TestCase):
+    """
+    Output equivalence of the join modes against the default join.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix="test_keyed_join_")
+        rnd = random.Random(0)
+        cls.left = os.path.join(cls.dir, "left.tsv")
+        write_table(cls.left, ["id", "grp", "dt", "x"],
+                    [[rnd.randint(0, 500), rnd.choice("abc"),
+                      rnd.randint(0, 100), x] for x in xrange(3000)])
+        # large enough for a 1 MB budget to partition it
+        cls.right = os.path.join(cls.dir, "right.tsv")
+        write_table(cls.right, ["id", "grp", "dt", "y", "pad"],
+                    [[rnd.randint(0, 600), rnd.choice("abc"),
+                      rnd.randint(0, 100), x, "p" * 20]
+                     for x in xrange(20000)])
+        cls.other = os.path.join(cls.dir, "other.tsv")
+        write_table(cls.other, ["id", "grp", "z"],
+                    [[x, y, "z%d" % rnd.randint(0, 9)] for x in xrange(700)
+                     for y in "abc"])
+        cls.files = [cls.right, cls.other]
+        cls.keys = ["-k", "id", "-k", "grp"]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def join(self, args, files=None):
+        """
+        Join the test files, checking the join succeeded.
+        @param args list of extra command line arguments
+        @param files list of the files after the first.  Defaults to
+               self.files
+        @return list of the output lines
+        """
+        status, out = run_join(self.keys + args + (files or self.files),
+                               self.left)
+        self.assertEqual(status, 0)
+        return out.splitlines()
+
+    def assertSameRecords(self, args, ordered=False, files=None, base=[]):
+        """
+        Check a join writes the header and records of the default join.
+        @param args list of extra command line arguments
+        @param ordered if True the records must also be in the same order
+        @param files see join
+        @param base list of command line arguments of both joins
+        """
+        expected = self.join(base, files)
+        actual = self.join(base + args, files)
+        self.assertGreater(len(expected), 1)
+        self.assertEqual(actual[0], expected[0])
+        if ordered:
+            self.assertEqual(actual[1:], expected[1:])
+        else:
+            self.assertEqual(sorted(actual[1:]), sorted(expected[1:]))
+
+    def test_cores(self):
+        self.assertSameRecords(["-C", "3"])
+
+    def test_cores_ordered(self):
+        self.assertSameRecords(["-C", "3", "-o"], True)
+
+    def test_budget(self):
+        self.assertSameRecords(["-B", "1"], True)
+
+    def test_cores_budget(self):
+        self.assertSameRecords(["-C", "2", "-B", "1"])
+
+    def test_loaders(self):
+        self.assertSameRecords(["-j", "3"], True)
+
+    def test_index(self):
+        index_dir = os.path.join(self.dir, "index")
+        for mm in (["-s", "dt"], ["-G", "dt"], ["-c", "dt"]):
+            # the first run saves the indices, the second maps them
+            self.assertSameRecords(["-I", index_dir], True, base=mm)
+            self.assertSameRecords(["-I", index_dir], True, base=mm)
+        shutil.rmtree(index_dir)
+
+    def test_mapped_constraint_index(self):
+        import keyed_join
+        index_dir = os.path.join(self.dir, "mapped")
+        hdr = ["id", "grp", "dt", "y", "pad"]
+        lookups = list()
+        # the first lookup is built (and saved), the second mapped
+        for idx in xrange(2):
+            f = keyed_join.fileinput.FileInput(self.right)
+            f.readline()
+            lookups.append(keyed_join.indexed_lookup(f, hdr, ["id", "grp"],
+                                                     None, "\t", index_dir,
+                                                     0, (0,)))
+            f.close()
+        built, mapped = lookups
+        self.assertIsInstance(mapped, keyed_join.MappedLookup)
+        self.assertTrue(any(isinstance(x, keyed_join.ConstraintIndex) for x
+                            in built.itervalues()))
+        for key in built:
+            self.assertEqual(type(mapped[key]), type(built[key]))
+            self.assertEqual(list(mapped[key]), list(built[key]))
+        mapped.close()
+        shutil.rmtree(index_dir)
+
+    def test_sorted(self):
+        names = list()
+        for fname in [self.left] + self.files:
+            names.append(fname + ".sorted")
+            sort_table(fname, names[-1], [0, 1])
+        expected = self.join([])
+        status, out = run_join(self.keys + ["--sorted"] + names[1:],
+                               names[0])
+        self.assertEqual(status, 0)
+        actual = out.splitlines()
+        self.assertEqual(actual[0], expected[0])
+        self.assertEqual(sorted(actual[1:]), sorted(expected[1:]))
+        # unsorted input is rejected
+        status, out = run_join(self.keys + ["--sorted"] + self.files,
+                               names[0])
+        self.assertEqual(status, 4)
+
+    def test_constraint_index(self):
+        import keyed_join
+        rnd = random.Random(1)
+        fns = [keyed_join.select_next_smallest,
+               keyed_join.select_strictly_next_smallest,
+               keyed_join.select_next_largest,
+               keyed_join.select_strictly_next_largest,
+               keyed_join.select_closest]
+        for trial in xrange(50):
+            items = [(str(rnd.randint(0, 30)), str(x)) for x in
+                     xrange(rnd.randint(1, 40))]
+            index = keyed_join.ConstraintIndex(items, (0,))
+            for val in xrange(-2, 33):
+                for fn in fns:
+                    self.assertEqual(fn(index, (0,), [str(val)]),
+                                     fn(items, (0,), [str(val)]))
+
+    def test_remove_field(self):
+        expected = self.join([])
+        hdr = expected[0].split("\t")
+        pos = hdr.index("x")
+        actual = self.join(["-r", "x"])
+        self.assertEqual(actual, ["\t".join(y[:pos] + y[pos + 1:]) for y in
+                                  [x.split("\t") for x in expected]])
+
+    def test_prescreen(self):
+        self.assertSameRecords(["-P"], True)
+        self.assertSameRecords(["-P", "-j", "2"], True)
+        self.assertSameRecords(["-P"], True, base=["-s", "dt"])
+        # ignored for outer joins
+        self.assertSameRecords(["-P"], True, base=["-l"])
+
+    def test_keep(self):
+        # keeping every field but pad of the later files is removing pad
+        self.assertEqual(self.join(["-K", "dt", "-K", "y", "-K", "z"]),
+                         self.join(["-r", "pad"]))
+        # multi-match fields are kept even when not listed
+        self.assertEqual(self.join(["-s", "dt", "-K", "y", "-K", "z"]),
+                         self.join(["-s", "dt", "-r", "pad"]))
+
+    def test_compact(self):
+        for compact in (["-z"], ["-zz"]):
+            self.assertSameRecords(compact, True)
+            self.assertSameRecords(compact, True, base=["-s", "dt"])
+            self.assertSameRecords(compact + ["-j", "2"], True)
+            self.assertSameRecords(compact + ["-P"], True)
+
+    def test_buffer(self):
+        for size in ("0", "100"):
+            self.assertSameRecords(["-b", size], True)
+            self.assertSameRecords(["-b", size, "-C", "2", "-o"], True)
+
+
+if __name__ == '__main__':
+    unittest.main()
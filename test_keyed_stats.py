@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+""" @namespace test_keyed_stats
+Check that each keyed_stats mode writes the same stats tables as the default
+in-memory mode.
+"""
+
+import sys
+import os
+import random
+import shutil
+import tempfile
+import subprocess
+import unittest
+import pickle
+import zlib
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+## the script under test
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "keyed_stats.py")
+
+## arguments building the test table: keys, a date window and every stat
+TABLE_ARGS = ["-H", "-k", "a", "-k", "b", "-k", "dt", "-D", "dt", "-w", "2",
+              "-f", "val", "-c", "-x", "-X", "-m", "-M"]
+
+
+def write_table(fname, hdr, rows, delim="\t"):
+    """
+    Write a header and records to a file.
+    @param fname name of the file to write
+    @param hdr list of field names
+    @param rows iterable of lists of field values
+    @param delim the field separator
+    """
+    with open(fname, "w") as f:
+        f.write(delim.join(hdr) + "\n")
+        for row in rows:
+            f.write(delim.join([str(x) for x in row]) + "\n")
+
+
+def run_stats(args, stdin_name=None):
+    """
+    Run keyed_stats.py.
+    @param args list of command line arguments
+    @param stdin_name if given, name of a file to read stdin from
+    @return 2-tuple containing the exit status and the output written
+    """
+    stdin = open(stdin_name) if stdin_name is not None else open(os.devnull)
+    p = subprocess.Popen([sys.executable, SCRIPT] + args, stdin=stdin,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    stdin.close()
+    return (p.returncode, out)
+
+
+class KeyedStatsModeTest(unittest.TestCase):
+    """
+    Output equivalence of the stats modes against the default mode.  Values
+    are small integers so that sums are exact in any order, and few enough
+    per keyset that sketches (with -K 5000) are exact too.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix="test_keyed_stats_")
+        rnd = random.Random(0)
+        rows = [[rnd.choice("pqrs"), rnd.randint(0, 2),
+                 "2013%02d" % rnd.randint(1, 6), rnd.randint(0, 40)]
+                for x in xrange(3000)]
+        hdr = ["a", "b", "dt", "val"]
+        cls.infile = os.path.join(cls.dir, "in.tsv")
+        write_table(cls.infile, hdr, rows)
+        cls.parts = list()
+        for idx in xrange(4):
+            cls.parts.append(os.path.join(cls.dir, "part%d.tsv" % idx))
+            write_table(cls.parts[-1], hdr, rows[idx::4])
+        status, out = run_stats(TABLE_ARGS + [cls.infile])
+        cls.table = out
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def path(self, name):
+        """
+        Name a file in the test directory.
+        @param name base name of the file
+        @return file name
+        """
+        return os.path.join(self.dir, name)
+
+    def stats(self, args, stdin_name=None):
+        """
+        Run keyed_stats.py, checking it succeeded.
+        @param args list of command line arguments
+        @param stdin_name see run_stats
+        @return the output written
+        """
+        status, out = run_stats(args, stdin_name)
+        self.assertEqual(status, 0)
+        return out
+
+    def assertSameTable(self, args, files=None):
+        """
+        Check a stats run writes the default table of the test input.
+        @param args list of extra command line arguments
+        @param files list of the input files.  Defaults to the test input
+        """
+        self.assertGreater(len(self.table.splitlines()), 1)
+        self.assertEqual(self.stats(TABLE_ARGS + args +
+                                    (files or [self.infile])), self.table)
+
+    def test_stream(self):
+        self.assertSameTable(["-s", "-K", "5000"])
+
+    def test_sketch_merge(self):
+        tables = list()
+        for idx, fname in enumerate(self.parts):
+            tables.append(self.path("sketched%d.tsv" % idx))
+            with open(tables[-1], "w") as f:
+                f.write(self.stats(TABLE_ARGS + ["-s", "-K", "5000", "-Z",
+                                                 tables[-1] + ".sketch",
+                                                 fname]))
+        merge = sum([["-R", x] for x in tables], [])
+        self.assertEqual(self.stats(merge), self.table)
+        self.assertEqual(self.stats(merge + ["--sorted"]), self.table)
+        self.assertEqual(self.stats(merge + ["--sorted", "-C", "2"]),
+                         self.table)
+
+    def test_cores(self):
+        self.assertSameTable(["-C", "3"])
+        self.assertSameTable(["-C", "3"], self.parts)
+        self.assertSameTable(["-C", "3", "-s", "-K", "5000"], self.parts)
+
+    def test_stats_ranges(self):
+        import keyed_stats
+        from cStringIO import StringIO
+        args = keyed_stats.prep_arg_parser().parse_args(TABLE_ARGS +
+                                                        [self.infile])
+        args.key = ["a", "b"]
+        args.backoff = [None, None]
+        d, runs = keyed_stats.ingest((self.infile, None, args))
+        stats_range = keyed_stats.STATS_RANGE
+        try:
+            # many small ranges, serially and on several cores
+            keyed_stats.STATS_RANGE = 7
+            for cores in (1, 3):
+                args.cores = cores
+                out = StringIO()
+                out.write(keyed_stats.stats_header(args) + "\n")
+                keyed_stats.write_stats(d, args, out)
+                self.assertEqual(out.getvalue(), self.table)
+        finally:
+            keyed_stats.STATS_RANGE = stats_range
+
+    @unittest.skipIf(np is None, "-N requires numpy")
+    def test_numpy(self):
+        self.assertSameTable(["-N"])
+
+    def test_keyset_cache(self):
+        # a cache smaller than the keys evicts, a larger one does not
+        self.assertSameTable(["-L", "20"])
+        self.assertSameTable(["-L", "5000"])
+
+    def test_budget(self):
+        # 20KB, a few dozen keysets
+        self.assertSameTable(["-B", "0.02"])
+        self.assertSameTable(["-B", "0.02", "-s", "-K", "5000"])
+        self.assertSameTable(["-B", "0.02", "-C", "3"], self.parts)
+        # saved state must be held in memory
+        status, out = run_stats(TABLE_ARGS + ["-B", "0.02", "-S",
+                                              self.path("st"), self.infile])
+        self.assertEqual(status, 2)
+
+    def test_update(self):
+        state = self.path("state")
+        self.stats(TABLE_ARGS + ["-S", state] + self.parts[:2])
+        self.assertSameTable(["-S", state, "-u"], self.parts[2:])
+        # folding in no records leaves the saved stats as they were
+        empty = self.path("empty.tsv")
+        write_table(empty, ["a", "b", "dt", "val"], [])
+        self.assertSameTable(["-S", state, "-u"], [empty])
+        os.remove(state)
+        # retaining 201304-201306 keeps just the months whose -w 2 window
+        # is complete, plus all month rows over what is retained
+        self.stats(TABLE_ARGS + ["-S", state, "-r", "3"] + self.parts[:2])
+        retained = self.stats(TABLE_ARGS + ["-S", state, "-u", "-r", "3"] +
+                              self.parts[2:]).splitlines()
+        with open(self.infile) as f:
+            latest = [f.readline()] + [x for x in f if
+                                       x.split("\t")[2] >= "201304"]
+        infile = self.path("latest.tsv")
+        with open(infile, "w") as f:
+            f.writelines(latest)
+        expected = [x for x in self.stats(TABLE_ARGS + [infile]).splitlines()
+                    if x.split("\t")[2] in ("", "dt") or
+                    x.split("\t")[2] >= "201304"]
+        self.assertEqual(retained, expected)
+        self.assertEqual([x for x in retained if x.split("\t")[2]],
+                         [x for x in self.table.splitlines() if
+                          x.split("\t")[2] in ("dt", "201304", "201305",
+                                               "201306")])
+        os.remove(state)
+
+    def test_snapshots(self):
+        snap = self.path("snap.tsv")
+        # the last dump falls on the last record, so it is up to date
+        self.assertSameTable(["-P", "500", "-O", snap, "-s", "-K", "5000"])
+        latest = dict()
+        with open(snap) as f:
+            for line in f:
+                if not line.startswith("#snapshot"):
+                    latest[tuple(line.split("\t")[:3])] = line
+        # including the header, written once at the start
+        self.assertEqual(sorted(latest.itervalues()),
+                         sorted(self.table.splitlines(True)))
+        os.remove(snap)
+        # snapshots of partial stats, or that sort every value, are refused
+        for args in (["-B", "20"], ["-C", "2"], ["-S", self.path("st")]):
+            status, out = run_stats(TABLE_ARGS + ["-P", "500", "-O", snap,
+                                                  "-s"] + args + [self.infile])
+            self.assertEqual(status, 2)
+        status, out = run_stats(TABLE_ARGS + ["-P", "500", "-O", snap,
+                                              self.infile])
+        self.assertEqual(status, 2)
+
+    def test_sorted_merge(self):
+        # without sketches merges approximate, but the same way in any mode
+        tables = list()
+        for idx, fname in enumerate(self.parts):
+            tables.append(self.path("plain%d.tsv" % idx))
+            with open(tables[-1], "w") as f:
+                f.write(self.stats(TABLE_ARGS + [fname]))
+        merge = sum([["-R", x] for x in tables], [])
+        expected = self.stats(merge)
+        self.assertGreater(len(expected.splitlines()), 1)
+        self.assertEqual(self.stats(merge + ["--sorted"]), expected)
+        self.assertEqual(self.stats(merge + ["--sorted", "-C", "2"]),
+                         expected)
+
+    def test_binary(self):
+        table = self.path("table.ksb")
+        self.assertSameTable(["-b", table])
+        self.assertEqual(self.stats(["-R", table]), self.table)
+        # sketched binary shards merge to the full table
+        tables = list()
+        for idx, fname in enumerate(self.parts):
+            tables.append(self.path("sketched%d.ksb" % idx))
+            self.stats(TABLE_ARGS + ["-s", "-K", "5000", "-b", tables[-1],
+                                     fname])
+        merge = sum([["-R", x] for x in tables], [])
+        self.assertEqual(self.stats(merge), self.table)
+        self.assertEqual(self.stats(merge + ["--sorted"]), self.table)
+        # unsketched binary shards merge as their text tables do
+        texts = list()
+        tables = list()
+        for idx, fname in enumerate(self.parts):
+            texts.append(self.path("plain%d.txt" % idx))
+            tables.append(self.path("plain%d.ksb" % idx))
+            with open(texts[-1], "w") as f:
+                f.write(self.stats(TABLE_ARGS + ["-b", tables[-1], fname]))
+        for args in ([], ["--sorted"]):
+            self.assertEqual(self.stats(sum([["-R", x] for x in tables], []) +
+                                        args),
+                             self.stats(sum([["-R", x] for x in texts], []) +
+                                        args))
+
+    def test_binary_alpha(self):
+        # values that only look numeric are kept as written
+        infile = self.path("alpha.tsv")
+        write_table(infile, ["a", "val"],
+                    [[x, y] for x in "pq" for y in
+                     ["02134", "02134", "1e3", "7.50", " 7", "nan", "10"]])
+        table = self.path("alpha.ksb")
+        args = ["-H", "-k", "a", "-f", "val", "-a", "-c", "-x", "-X", "-M"]
+        expected = self.stats(args + ["-b", table, infile])
+        self.assertIn("02134", expected)
+        self.assertEqual(self.stats(["-R", table]), expected)
+
+    def test_alpha(self):
+        infile = self.path("order.tsv")
+        write_table(infile, ["a", "val"], [["p", x] for x in (9, 10, 10)])
+        args = ["-H", "-k", "a", "-f", "val", "-M", infile]
+        # (mode, 1st and 99th percentiles)
+        numeric = self.stats(args).splitlines()[-1].split("\t")
+        alpha = self.stats(["-a"] + args).splitlines()[-1].split("\t")
+        self.assertEqual([numeric[x] for x in (1, 2, -1)],
+                         ["10.0", "9.0", "10.0"])
+        # alphabetically "10" sorts before "9"
+        self.assertEqual([alpha[x] for x in (1, 2, -1)], ["10", "10", "9"])
+
+    def test_merge_stdin(self):
+        table = self.path("stdin.tsv")
+        with open(table, "w") as f:
+            f.write(self.table)
+        self.assertEqual(self.stats(["-R", "-"], table), self.table)
+        self.assertEqual(self.stats(["-R", "-", "--sorted"], table),
+                         self.table)
+
+    def test_binary_header(self):
+        # header names in any encoding are kept as written
+        for name in ("caf\xc3\xa9", "caf\xe9"):
+            infile = self.path("header.tsv")
+            write_table(infile, [name, "val"], [["p", 1], ["q", 2]])
+            table = self.path("header.ksb")
+            expected = self.stats(["-H", "-k", name, "-f", "val", "-c", "-b",
+                                   table, infile])
+            self.assertTrue(expected.startswith(name + "\t"))
+            self.assertEqual(self.stats(["-R", table]), expected)
+
+    def test_missing_min_max(self):
+        # NaN (missing) values are skipped, even when read first
+        infile = self.path("missing.tsv")
+        write_table(infile, ["a", "val"], [["p", x] for x in
+                                           ("nan", 1, 2, "nan")])
+        args = ["-H", "-k", "a", "-f", "val", "-x", "-X", infile]
+        for mode in ([], ["-s"]) + ((["-N"],) if np is not None else ()):
+            row = self.stats(mode + args).splitlines()[-1].split("\t")
+            self.assertEqual(row[1:3], ["1.0", "2.0"])
+
+    def test_sketch_format(self):
+        import keyed_stats
+        sketchfile = self.path("format.sketch")
+        table = self.stats(TABLE_ARGS + ["-s", "-K", "5000", "-Z",
+                                         sketchfile, self.infile])
+        counts = [int(x.split("\t")[3]) for x in table.splitlines()[1:]]
+        # sketches written by the script load outside of it
+        with open(sketchfile) as f:
+            sketches = [keyed_stats.StreamStatList.loads(x.split("\t")[-1])
+                        for x in f]
+        self.assertEqual([x.get_count() for x in sketches], counts)
+        for x in sketches:
+            y = keyed_stats.StreamStatList.from_bytes(x.to_bytes())
+            self.assertEqual([y.get_mean(), y.get_mode(),
+                              y.get_percentiles([1, 50, 99])],
+                             [x.get_mean(), x.get_mode(),
+                              x.get_percentiles([1, 50, 99])])
+        # other data, pickles included, is refused
+        for data in ("", "x", zlib.compress(pickle.dumps(sketches[0], 2))):
+            self.assertRaises(keyed_stats.StatsFormatError,
+                              keyed_stats.StreamStatList.from_bytes, data)
+
+
+if __name__ == '__main__':
+    unittest.main()